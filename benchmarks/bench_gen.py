@@ -0,0 +1,82 @@
+#
+# Created by Aaron Beckett January, 2016
+#
+# Compares the time and peak memory of expanding a gen file's parameter
+# values into configs with the old list building generateCombos and
+# with the streaming one in ctip_funcs, at 10^4, 10^5 and 10^6 configs
+# (parameters of 10 values each). Every run is made in its own process
+# so its peak RSS can be read on its own.
+#
+#   python benchmarks/bench_gen.py [<max exponent>]
+#
+
+import os
+import sys
+import time
+import resource
+from copy import deepcopy
+from subprocess import Popen, PIPE
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ctip_constants as ctip
+from ctip_utils import chunks
+from ctip_funcs import generateCombos
+
+def oldGenerateCombos(combos, vals):
+    """generateCombos as it was, called once per parameter with reduce."""
+    new_combos = []
+    if not combos:
+        for val in vals:
+            new_combos.append([val])
+    else:
+        for combo in combos:
+            for val in vals:
+                new_combo = deepcopy(combo)
+                new_combo.append(val)
+                new_combos.append(new_combo)
+    return new_combos
+
+def runOld(value_lists):
+    count = 0
+    for chunk in chunks(reduce(oldGenerateCombos, value_lists, []), ctip.CONFIG_CHUNK_SIZE):
+        count += len(chunk)
+    return count
+
+def runNew(value_lists):
+    count = 0
+    for chunk in chunks(generateCombos(value_lists), ctip.CONFIG_CHUNK_SIZE):
+        count += len(chunk)
+    return count
+
+def measure(impl, exponent):
+    """Expand 'exponent' parameters with one implementation, in this process."""
+    value_lists = [range(10)] * exponent
+    start = time.time()
+    count = {'old': runOld, 'new': runNew}[impl](value_lists)
+    seconds = time.time() - start
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print("{0} {1:.2f} {2:.1f}".format(count, seconds, peak))
+
+def main(argv):
+    if len(argv) == 4 and argv[1] == '--measure':
+        measure(argv[2], int(argv[3]))
+        return
+
+    max_exponent = int(argv[1]) if len(argv) > 1 else 6
+    print("{0:>9} {1:>10} {2:>12} {3:>10} {4:>12}".format(
+        'configs', 'old time', 'old peak', 'new time', 'new peak'))
+    for exponent in range(4, max_exponent + 1):
+        results = []
+        for impl in ('old', 'new'):
+            proc = Popen([sys.executable, os.path.abspath(__file__), '--measure',
+                          impl, str(exponent)], stdout=PIPE)
+            count,seconds,peak = proc.communicate()[0].split()
+            results.append( (float(seconds), float(peak)) )
+        (old_s, old_mb),(new_s, new_mb) = results
+        print("{0:>9} {1:>9.2f}s {2:>10.1f}MB {3:>9.2f}s {4:>10.1f}MB".format(
+            count, old_s, old_mb, new_s, new_mb))
+
+if __name__ == '__main__':
+    main(sys.argv)
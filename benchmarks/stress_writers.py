@@ -0,0 +1,84 @@
+#
+# Created by Aaron Beckett January, 2016
+#
+# Stress test of many jobs writing to the ctip database at once. Forks
+# <writers> processes that all start at the same moment and each run
+# the writes of a job's 'ctip log start', 'ctip update status done' and
+# 'ctip log end' against a scratch database. Reports how many writers
+# succeeded, how many jobs ended up recorded as done with a runtime, and
+# how often and how long the writers backed off from a locked database.
+#
+#   python benchmarks/stress_writers.py [<writers>] [<busy timeout>] [<journal mode>]
+#
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ctip_constants as ctip
+
+def main(argv):
+    writers = int(argv[1]) if len(argv) > 1 else 1000
+    if len(argv) > 2:
+        ctip.DB_BUSY_TIMEOUT = float(argv[2])
+    if len(argv) > 3:
+        ctip.DB_JOURNAL_MODE = None if argv[3].lower() == 'none' else argv[3]
+
+    # Point ctip at a scratch database before the manager reads its path
+    scratch = tempfile.mkdtemp()
+    ctip.CONFIG_DB = os.path.join(scratch, "stress.db")
+    from ctip_dbm import DatabaseManager
+
+    manager = DatabaseManager()
+    session_id = manager.newSession('stress', 'stress', time.strftime("%Y-%m-%d %H:%M:%S"))
+    manager.addJobsToSession(session_id, [(i, str(i)) for i in range(writers)])
+    manager.conn.close()
+
+    # Every writer reports 'ok <retries> <seconds backed off>' or 'error <msg>'
+    read_end,write_end = os.pipe()
+    go = time.time() + 3
+    pids = []
+    for i in range(writers):
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_end)
+            time.sleep(max(0, go - time.time()))
+            try:
+                db = DatabaseManager()
+                db.startJob(str(i))
+                db.updateJobStatus(str(i), 'done')
+                db.endJob(str(i))
+                report = "ok {0} {1}\n".format(DatabaseManager.retries,
+                                               DatabaseManager.retry_seconds)
+            except Exception as e:
+                report = "error {0}\n".format(getattr(e, "msg", repr(e)))
+            os.write(write_end, report)
+            os._exit(0)
+        pids.append(pid)
+    os.close(write_end)
+
+    with os.fdopen(read_end) as results:
+        reports = [line.split(' ', 1) for line in results.read().splitlines()]
+    for pid in pids:
+        os.waitpid(pid, 0)
+
+    ok = [fields[1].split() for fields in reports if fields[0] == 'ok']
+    errors = [fields[1] for fields in reports if fields[0] == 'error']
+    manager = DatabaseManager()
+    s = "SELECT count(*) FROM jobs WHERE status = 'done' AND runtime IS NOT NULL"
+    done = manager.conn.execute(s).fetchone()[0]
+
+    print("{0} writers, {1} ok, {2} failed, {3} jobs recorded done".format(
+        writers, len(ok), len(errors), done))
+    if ok:
+        print("{0} retries (at most {1} by one writer), {2:.2f}s backed off in all".format(
+            sum(int(r) for r,s in ok), max(int(r) for r,s in ok),
+            sum(float(s) for r,s in ok)))
+    for error in errors[:3]:
+        print(error)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -2,36 +2,126 @@
 # Created by Aaron Beckett January, 2016
 #
 
+import os
+import sys
+import csv
+import json
+import time
+from functools import partial
+
 import ctip_funcs
 from ctip_dbm import DatabaseManager
-from ctip_constants import RUN_CONFIG
-_run_module = __import__(RUN_CONFIG)
-run_cfg = _run_module.runConfig
+from ctip_utils import CTIPError, parseWalltime, openFile
+from ctip_journal import appendEvent
+from ctip_executors import PbsExecutor, ArrayExecutor, BundleExecutor, LocalExecutor, \
+    RetryExecutor
+from ctip_constants import RUN_CONFIG, SUBMIT_JOBS, RETRY_ATTEMPTS, RETRY_FAILURES, \
+    WATCH_INTERVAL, BUNDLE_CORES
+
+def run_module():
+    """
+    Import the run config module on first use, so commands run from
+    inside jobs (log, update) don't pay for importing it.
+    """
+    return __import__(RUN_CONFIG)
 
 def run_table(args):
     run(args.table_name, args)
 
 def run_file(args):
-    with open(args.csv_file, 'r') as cfg_file:
-        table = ctip_funcs.createConfigTable(cfg_file)
+    with openFile(args.csv_file, 'r') as cfg_file:
+        table = ctip_funcs.createConfigTable(cfg_file, args.merge)
     run(table, args)
 
 def run_gen(args):
     with open(args.gen_file, 'r') as cfg_schema:
-        table = ctip_funcs.generateConfigTable(cfg_schema)
+        table = ctip_funcs.generateConfigTable(cfg_schema, args.merge, args.sample,
+                                               args.stride, args.lhs, args.seed)
     run(table, args)
 
 def run(table, args):
+    module = run_module()
+    if args.local:
+        mode = 'local'
+    elif args.array:
+        mode = 'array'
+    elif args.bundle or args.bundle_walltime:
+        mode = 'bundle'
+    else:
+        mode = 'pbs'
+    executor = make_executor(module, mode, args)
+
     # Initialize the test session!
-    ctip_funcs.initTestSession(
-        run_cfg,
+    skipped = ctip_funcs.initTestSession(
+        executor,
         table,
         ' '.join(args.where_clause),
         args.outdir,
         args.qsub,
-        args.name
+        args.name,
+        getattr(module, 'checkConfigs', None),
+        args.force
     )
-    print("Jobs submitted!")
+    if skipped:
+        print("Skipped {0} configs already finished by earlier sessions "
+              "(--force runs them again)".format(skipped))
+    if args.local:
+        print("Jobs finished!")
+    else:
+        print("Jobs submitted!")
+
+def run_resume(args):
+    module = run_module()
+    session = DatabaseManager().getSession(args.session_id)
+    if not session:
+        raise CTIPError("Invalid session id: {0}".format(args.session_id))
+    mode = session['mode'] or 'pbs'
+    executor = make_executor(module, mode, args, session)
+
+    skipped = ctip_funcs.resumeTestSession(
+        executor,
+        args.session_id,
+        getattr(module, 'checkConfigs', None)
+    )
+    print("Skipped {0} configs that were already {1}".format(
+        skipped, 'run' if mode == 'local' else 'submitted'))
+    if mode == 'local':
+        print("Jobs finished!")
+    else:
+        print("Jobs submitted!")
+
+def make_executor(module, mode, args, session=None):
+    """
+    Get the executor for a run mode, waiting on the session's outdir and
+    qsub. A resumed 'session' gives the bundle settings not in 'args'.
+    """
+    if mode == 'local':
+        return partial(LocalExecutor, init_func(module), jobs=args.jobs,
+                       mem=args.mem, walltime=parseWalltime(args.walltime))
+    elif mode == 'array':
+        return partial(ArrayExecutor, init_func(module),
+                       jobs=args.jobs or SUBMIT_JOBS)
+    elif mode == 'bundle':
+        size = args.bundle
+        walltime = parseWalltime(args.bundle_walltime)
+        cores = args.bundle_cores
+        if session and not (size or walltime):
+            size,walltime = session['bundle_size'],session['bundle_walltime']
+        if session and not cores:
+            cores = session['bundle_cores']
+        if not (size or walltime):
+            raise CTIPError("Bundled sessions need --bundle or --bundle-walltime")
+        return partial(BundleExecutor, init_func(module), jobs=args.jobs or SUBMIT_JOBS,
+                       size=size, walltime=walltime, cores=cores or BUNDLE_CORES)
+    return partial(PbsExecutor, module.runConfig, jobs=args.jobs or SUBMIT_JOBS)
+
+def init_func(module):
+    """Get the run config function that builds a run without submitting it."""
+    func = getattr(module, 'initJob', None)
+    if not func:
+        raise CTIPError("Array, bundled and local runs and retries need an initJob function in "
+                        + RUN_CONFIG)
+    return func
 
 def tables(args):
     db = DatabaseManager()
@@ -39,105 +129,188 @@ def tables(args):
 
 def list(args):
     db = DatabaseManager()
-    db.printTable(args.table_name, ' '.join(args.where_clause))
+    db.printTable(args.table_name, ' '.join(args.where_clause),
+                  args.limit, args.offset, args.format)
 
 def save(args):
     out_file_name = args.outfile
     if not out_file_name:
         out_file_name = args.table_name + '.csv'
+    if args.gzip and not out_file_name.endswith('.gz'):
+        out_file_name += '.gz'
 
-    with open(out_file_name, 'w') as outfile:
-        ctip_funcs.storeSnapshot(args.table_name, outfile)
+    with openFile(out_file_name, 'w') as outfile:
+        count = ctip_funcs.storeSnapshot(args.table_name, outfile,
+                                         ' '.join(args.where_clause))
+    print("Saved {0} configs to {1}".format(count, out_file_name))
 
 def check(args):
-    only_one = False
-    if args.session_id:
-        only_one = True
-    summary = ctip_funcs.checkSession(args.session_id)
-
-    if only_one:
-        r = summary[0]
-        where = ""
-        if r['where_clause']:
-            where = r['where_clause']
-        print("{0:>12}: {1}".format('id', r['id']))
-        print("{0:>12}: {1}".format('session name', r['name']))
-        print("{0:>12}: {1} {2}".format('configs', r['config_group'],where))
-        print("{0:>12}: {1}".format('date', r['date']))
-
-        total = 0
-        for line in summary:
-            total += line['count()']
-        for line in summary:
-            percent = percentString(line['count()'], total)
-            print("{0:>12}: {1}".format(line['status'], percent))
+    if args.watch:
+        watch(args)
+        return
+    summary = ctip_funcs.checkSession(args.session_id, not args.no_sync,
+                                      args.format == 'table')
+    if args.session_id and not summary:
+        raise CTIPError("Invalid session id: {0}".format(args.session_id))
+
+    if args.format == 'json':
+        print(json.dumps(summary, indent=2))
+    elif args.format == 'csv':
+        writer = csv.DictWriter(sys.stdout, DatabaseManager.summary_fields)
+        writer.writerow(dict((f, f) for f in DatabaseManager.summary_fields))
+        writer.writerows(summary)
+    elif args.session_id:
+        printSession(summary[0])
     else:
-        line_format = "{0:<6} {1:8} {2:8} {3:8} {4:8}"
-        cols = ['id','queued','running','done','other'] 
-        seps = ['-'*5]
-        for i in range(4):
-            seps.append('-' * 7)
-        print(line_format.format(*cols))
-        print(line_format.format(*seps))
-
-        reports = {}
-        for line in summary:
-            session = line['id']
-            status = line['status']
-            count = line['count()']
-
-            if session not in reports:
-                reports[session] = [0] * 5
-
-            reports[session][4] += count
-            if status == 'queued':
-                reports[session][0] = count
-            elif status == 'running':
-                reports[session][1] = count
-            elif status == 'done':
-                reports[session][2] = count
-            else:
-                reports[session][3] = count
-
-        for id,report in reports.items():
-            total = report[4]
-            q = percentString(report[0], total)
-            r = percentString(report[1], total)
-            d = percentString(report[2], total)
-            o = percentString(report[3], total)
-            print(line_format.format(id, q, r, d, o))
+        printSessions(summary)
+
+def watch(args):
+    def show(summary, changed, rate, eta):
+        if sys.stdout.isatty():
+            sys.stdout.write("\033[H\033[2J")
+        if args.session_id and summary:
+            printSession(summary[0])
+        else:
+            printSessions(summary)
+        print("")
+        print("{0} status changes at {1}, {2} jobs/min, ETA {3}".format(
+            changed, time.strftime("%H:%M:%S"),
+            "{0:.1f}".format(rate) if rate is not None else "-",
+            durationString(eta) if eta is not None else "-"))
+        sys.stdout.flush()
+
+    try:
+        ctip_funcs.watchSessions(show, args.session_id, args.interval or WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+
+def printSession(r):
+    """Print the summary of one session, and the runtimes of its jobs."""
+    print("{0:>12}: {1}".format('id', r['id']))
+    print("{0:>12}: {1}".format('session name', r['name']))
+    print("{0:>12}: {1} {2}".format('configs', r['config_group'], r['where_clause'] or ""))
+    print("{0:>12}: {1}".format('date', r['date']))
+    print("{0:>12}: {1}".format('jobs', r['jobs']))
+    for status in ('queued', 'running', 'done', 'error', 'lost', 'other'):
+        if r[status]:
+            print("{0:>12}: {1}".format(status, percentString(r[status], r['jobs'])))
+    print("{0:>12}: {1:.0f}%".format('progress', r['progress'] * 100))
+
+    stats = DatabaseManager().getRuntimeStats(r['id'])
+    if stats['count']:
+        print("")
+        print("{0:>12}: {1:.2f}".format('cpu hours', stats['total'] / 3600.0))
+        print("{0:>12}: {1}".format('mean', durationString(stats['mean'])))
+        print("{0:>12}: {1}".format('p50', durationString(stats['p50'])))
+        print("{0:>12}: {1}".format('p95', durationString(stats['p95'])))
+        print("{0:>12}:".format('slowest'))
+        for config_id,job_id,seconds in stats['slowest']:
+            print("{0:>12}  config {1} ({2}): {3}".format(
+                '', config_id, job_id, durationString(seconds)))
+
+def printSessions(summary):
+    """Print a table with a line for every session."""
+    line_format = "{0:<6} {1:>8} {2:>8} {3:>8} {4:>8} {5:>8} {6:>8} {7:>8} {8:>10}"
+    cols = ['id', 'jobs', 'queued', 'running', 'done', 'error', 'lost', 'other', 'cpu hours']
+    seps = ['-' * 5] + ['-' * 7] * 7 + ['-' * 9]
+    print(line_format.format(*cols))
+    print(line_format.format(*seps))
+
+    for r in summary:
+        total = r['jobs'] or 1
+        counts = [percentString(r[status], total)
+                  for status in ('queued', 'running', 'done', 'error', 'lost', 'other')]
+        hours = "{0:.2f}".format(r['runtime_seconds'] / 3600.0)
+        print(line_format.format(r['id'], r['jobs'], *(counts + [hours])))
 
 def percentString(part, whole):
     return "{0:.0f}%".format(part/float(whole) * 100)
 
+def durationString(seconds):
+    seconds = int(round(seconds))
+    return "{0}:{1:02d}:{2:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def journaled(job_id, event, value=''):
+    """
+    Append the event to the job event journal named by CTIP_JOURNAL,
+    if it's set. Returns False if the event must go to the database.
+    """
+    journal = os.environ.get('CTIP_JOURNAL')
+    if journal:
+        appendEvent(journal, job_id, event, value)
+    return bool(journal)
+
 def update_status(args):
-    db = DatabaseManager()
-    db.updateJobStatus(args.job_id, args.new_status)
+    if not journaled(args.job_id, 'status', args.new_status):
+        db = DatabaseManager()
+        db.updateJobStatus(args.job_id, args.new_status)
 
 def update_id(args):
-    db = DatabaseManager()
-    db.updateJobId(args.job_id, args.new_id)
+    if not journaled(args.job_id, 'id', args.new_id):
+        db = DatabaseManager()
+        db.updateJobId(args.job_id, args.new_id)
 
 def log_start(args):
-    db = DatabaseManager()
-    db.startJob(args.job_id)
+    if not journaled(args.job_id, 'start'):
+        db = DatabaseManager()
+        db.startJob(args.job_id)
 
 def log_pause(args):
-    db = DatabaseManager()
-    db.pauseJob(args.job_id)
+    if not journaled(args.job_id, 'pause'):
+        db = DatabaseManager()
+        db.pauseJob(args.job_id)
 
 def log_resume(args):
-    db = DatabaseManager()
-    db.resumeJob(args.job_id)
+    if not journaled(args.job_id, 'resume'):
+        db = DatabaseManager()
+        db.resumeJob(args.job_id)
 
 def log_end(args):
-    db = DatabaseManager()
-    db.endJob(args.job_id)
+    if not journaled(args.job_id, 'end'):
+        db = DatabaseManager()
+        db.endJob(args.job_id)
+
+def ingest(args):
+    events,seconds = ctip_funcs.ingestJournals(args.session_id)
+    print("Ingested {0} job events in {1:.2f}s".format(events, seconds))
+
+def retry(args):
+    module = run_module()
+    executor = partial(RetryExecutor, init_func(module), jobs=args.jobs or SUBMIT_JOBS)
+    report = ctip_funcs.retrySession(
+        executor,
+        args.session_id,
+        args.max_attempts or RETRY_ATTEMPTS,
+        args.failures or RETRY_FAILURES
+    )
+
+    if not report:
+        print("No failed jobs to retry")
+        return
+    print("{0:<10} {1:>8} {2:>12}".format('failure', 'jobs', 'resubmitted'))
+    for failure,(found,resubmitted) in sorted(report.items()):
+        print("{0:<10} {1:>8} {2:>12}".format(failure, found, resubmitted))
 
 def clean(args):
     db = DatabaseManager()
     if args.session_id:
-        db.deleteSession(args.session_id)
+        sessions = [db.getSession(args.session_id)]
+        if not sessions[0]:
+            raise CTIPError("Invalid session id: {0}".format(args.session_id))
+    else:
+        sessions = db.getFinishedSessions(args.older_than)
+
+    if args.dry_run:
+        print("Sessions that would be deleted:")
     else:
-        db.deleteFinishedSessions()
+        db.deleteSessions([session['id'] for session in sessions])
+        print("Sessions deleted:")
+    for session in sessions:
+        print("{0:<6} {1} {2} {3}".format(session['id'], session['date'],
+            session['config_group'], session['name'] or ""))
 
+    if args.vacuum and not args.dry_run:
+        size = os.path.getsize(db.dbname)
+        db.vacuum()
+        print("Database shrunk from {0:.1f}MB to {1:.1f}MB".format(
+            size / 1048576.0, os.path.getsize(db.dbname) / 1048576.0))
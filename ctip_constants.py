@@ -8,6 +8,64 @@ ON_HPCC = True
 # Only edit these if you know what you're doing
 RUN_CONFIG = "example_run_config"
 
+# Default number of cores a bundled job (run --bundle) asks for, and so
+# the number of its configs it runs at the same time
+BUNDLE_CORES = 8
+
+# Number of configs held in memory at once while loading a config table
+CONFIG_CHUNK_SIZE = 10000
+
+# A config table column named in the where clauses of AUTO_INDEX_SESSIONS
+# of the table's sessions gets an index the next time the table is run
+# or loaded. Columns can also be indexed up front with a ':index' suffix
+# on their name in the config file header.
+AUTO_INDEX_SESSIONS = 3
+
+# Journal mode and synchronous pragmas used while bulk loading a config
+# table (None keeps the database's current setting). "MEMORY" and "OFF"
+# load faster, but a crash mid-load can then corrupt the whole database,
+# with every session's jobs in it.
+LOAD_JOURNAL_MODE = None
+LOAD_SYNCHRONOUS = None
+
+# Default number of configs submitted to the scheduler at once
+SUBMIT_JOBS = 8
+
+# Submitted job ids are recorded every JOB_FLUSH_COUNT jobs or every
+# JOB_FLUSH_SECONDS seconds, whichever comes first
+JOB_FLUSH_COUNT = 100
+JOB_FLUSH_SECONDS = 10
+
+# Name of the directory, inside each test session's output directory,
+# that jobs append their events to when CTIP_JOURNAL is set
+JOURNAL_DIR = "ctip_journal"
+
+# Settings for the many ctip processes writing to the database at once
+# from inside running jobs. Writers wait up to DB_BUSY_TIMEOUT seconds
+# for a lock, then retry up to DB_WRITE_RETRIES times with a jittered
+# backoff starting at DB_RETRY_BACKOFF seconds and doubling up to 32
+# times that. Set DB_JOURNAL_MODE to "WAL" only if every ctip process
+# runs on the same host as the database file, since WAL does not work
+# across machines on a network filesystem.
+DB_JOURNAL_MODE = None
+DB_BUSY_TIMEOUT = 30
+DB_WRITE_RETRIES = 8
+DB_RETRY_BACKOFF = 0.1
+
+# 'ctip retry' resubmits a config until it has been tried RETRY_ATTEMPTS
+# times, and only for the kinds of failure in RETRY_FAILURES. Every
+# walltime or memory failure multiplies the walltime or memory requested
+# by the config's next attempt by RETRY_WALLTIME_SCALE or RETRY_MEM_SCALE.
+RETRY_ATTEMPTS = 3
+RETRY_FAILURES = ['walltime', 'mem', 'io', 'lost']
+RETRY_WALLTIME_SCALE = 2
+RETRY_MEM_SCALE = 2
+
+# 'ctip check --watch' polls every WATCH_INTERVAL seconds, and works out
+# its throughput from the jobs finished in the last WATCH_RATE_WINDOW
+WATCH_INTERVAL = 60
+WATCH_RATE_WINDOW = 600
+
 # Shouldn't edit this unless you want your ctip
 # sqlite database file located in a specific place
 CONFIG_DB = CTIP_ROOT + "ctip.db"
@@ -2,134 +2,610 @@
 # Created by Aaron Beckett January, 2016
 #
 
+import os
+import re
+import sys
+import csv
+import json
+import time
+import random
+import hashlib
 import sqlite3 as sql
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
 
 import ctip_constants as ctip
-from ctip_utils import CTIPError
+from ctip_utils import CTIPError, chunks
+
+
+# Each migration upgrades the database schema by one version, tracked
+# with sqlite's user_version pragma. Only ever append to this list.
+MIGRATIONS = [
+    # 1: sessions and jobs tables
+    """
+    CREATE TABLE IF NOT EXISTS sessions(
+        id INTEGER PRIMARY KEY,
+        name TEXT,
+        config_group TEXT,
+        where_clause TEXT,
+        date TEXT
+    );
+
+    CREATE TABLE IF NOT EXISTS jobs(
+        session_id INT,
+        config_id INT,
+        job_id TEXT,
+        status TEXT,
+        time_log TEXT,
+        runtime TEXT,
+        PRIMARY KEY (session_id, job_id)
+    );
+    """,
+
+    # 2: per-job lookups and per-session status summaries
+    """
+    CREATE INDEX IF NOT EXISTS jobs_job_id ON jobs(job_id);
+    CREATE INDEX IF NOT EXISTS jobs_session_status ON jobs(session_id, status);
+    """,
+
+    # 3: session output directories and how far each job event journal
+    #    file has been ingested
+    """
+    ALTER TABLE sessions ADD COLUMN outdir TEXT;
+
+    CREATE TABLE IF NOT EXISTS journal_offsets(
+        path TEXT PRIMARY KEY,
+        byte_offset INTEGER
+    );
+    """,
+
+    # 4: what a session needs to be resumed
+    """
+    ALTER TABLE sessions ADD COLUMN qsub TEXT;
+    ALTER TABLE sessions ADD COLUMN mode TEXT;
+    """,
+
+    # 5: retry lineage, the job each retry replaces, which attempt at
+    #    its config it is and why a failed job failed
+    """
+    ALTER TABLE jobs ADD COLUMN retry_of TEXT;
+    ALTER TABLE jobs ADD COLUMN attempt INTEGER DEFAULT 1;
+    ALTER TABLE jobs ADD COLUMN failure TEXT;
+
+    CREATE INDEX IF NOT EXISTS jobs_retry_of ON jobs(session_id, retry_of);
+    """,
+
+    # 6: every interval a job ran for, and the running total of them
+    """
+    CREATE TABLE IF NOT EXISTS job_intervals(
+        session_id INT,
+        job_id TEXT,
+        start TEXT,
+        end TEXT
+    );
+    CREATE INDEX IF NOT EXISTS job_intervals_job_id ON job_intervals(job_id);
+
+    ALTER TABLE jobs ADD COLUMN runtime_seconds INTEGER DEFAULT 0;
+    UPDATE jobs SET runtime_seconds = CAST(runtime AS INTEGER) WHERE runtime IS NOT NULL;
+    INSERT INTO job_intervals(session_id, job_id, start)
+        SELECT session_id, job_id, time_log FROM jobs WHERE time_log IS NOT NULL;
+
+    CREATE INDEX IF NOT EXISTS jobs_session_runtime ON jobs(session_id, runtime_seconds);
+    """,
+
+    # 7: the content hash of every job's config and the directory its
+    #    results are in, so finished configs aren't run again
+    """
+    ALTER TABLE jobs ADD COLUMN config_hash TEXT;
+    ALTER TABLE jobs ADD COLUMN run_dir TEXT;
+
+    CREATE INDEX IF NOT EXISTS jobs_config_hash ON jobs(config_hash, status);
+    """,
+
+    # 8: the bundle size, walltime (seconds) and cores of bundled
+    #    sessions, so 'ctip run resume' bundles their configs the same way
+    """
+    ALTER TABLE sessions ADD COLUMN bundle_size INTEGER;
+    ALTER TABLE sessions ADD COLUMN bundle_walltime INTEGER;
+    ALTER TABLE sessions ADD COLUMN bundle_cores INTEGER;
+    """,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def retryOnLock(method):
+    """
+    Retry a DatabaseManager write method with jittered exponential
+    backoff for as long as the database is locked by other writers.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return method(self, *args, **kwargs)
+            except sql.OperationalError as e:
+                # Inside a batch the whole batch has to be retried
+                if not isLockError(e) or self.batching:
+                    raise
+                self.conn.rollback()
+                if attempt == ctip.DB_WRITE_RETRIES:
+                    raise CTIPError("Gave up after {0} retries: {1}".format(attempt, e))
+                # The backoff doubles with every attempt, up to 32 times the first
+                delay = random.uniform(0, ctip.DB_RETRY_BACKOFF * 2 ** min(attempt, 5))
+                DatabaseManager.retries += 1
+                DatabaseManager.retry_seconds += delay
+                time.sleep(delay)
+                attempt += 1
+    return wrapper
+
+def isLockError(error):
+    msg = str(error)
+    return 'locked' in msg or 'busy' in msg
 
 
 class DatabaseManager:
     """Handles interactions with the local SQLite Database used by ctip."""
 
     dbname = ctip.CONFIG_DB
-    reserved_table_names = [ 'sessions', 'jobs' ]
+    reserved_table_names = [ 'sessions', 'jobs', 'journal_offsets', 'job_intervals' ]
+
+    # Seconds this process has spent opening databases, and the number
+    # of (and seconds spent backing off for) locked writes, for reports
+    connect_seconds = 0.0
+    retries = 0
+    retry_seconds = 0.0
 
     def __init__(self):
-        self.conn = sql.connect(self.dbname)
+        start = time.time()
+        self.batching = False
+        self.conn = sql.connect(self.dbname, timeout=ctip.DB_BUSY_TIMEOUT)
         self.conn.row_factory = sql.Row
-        self.conn.executescript("""
-            CREATE TABLE IF NOT EXISTS sessions(
-                id INTEGER PRIMARY KEY,
-                name TEXT,
-                config_group TEXT,
-                where_clause TEXT,
-                date TEXT
-            );
-
-            CREATE TABLE IF NOT EXISTS jobs(
-                session_id INT,
-                config_id INT,
-                job_id TEXT,
-                status TEXT,
-                time_log TEXT,
-                runtime TEXT,
-                PRIMARY KEY (session_id, job_id)
-            );
-        """)
+        self.migrate()
+        if ctip.DB_JOURNAL_MODE:
+            self.setJournalMode(ctip.DB_JOURNAL_MODE)
+        DatabaseManager.connect_seconds += time.time() - start
+
+    @retryOnLock
+    def setJournalMode(self, mode):
+        # Reading the mode is cheap, only switch it when it differs
+        current = self.conn.execute("PRAGMA journal_mode").fetchone()[0]
+        if current.lower() != mode.lower():
+            self.conn.execute("PRAGMA journal_mode = {0}".format(mode))
+
+    @retryOnLock
+    def migrate(self):
+        """Upgrade the database schema in place to SCHEMA_VERSION."""
+        # Fast path: a read-only check that never takes the write lock
+        if self.schemaVersion() == SCHEMA_VERSION:
+            return
+
+        # Escalate to a write lock, then check again in case another
+        # ctip process upgraded the database while we were waiting
+        isolation_level = self.conn.isolation_level
+        self.conn.isolation_level = None
+        try:
+            self.conn.execute("BEGIN IMMEDIATE")
+            version = self.schemaVersion()
+            if version > SCHEMA_VERSION:
+                raise CTIPError("{0} was created by a newer version of ctip".format(self.dbname))
+            for v in range(version, SCHEMA_VERSION):
+                for stmt in MIGRATIONS[v].split(';'):
+                    if stmt.strip():
+                        self.conn.execute(stmt)
+            self.conn.execute("PRAGMA user_version = {0}".format(SCHEMA_VERSION))
+            self.conn.execute("COMMIT")
+        except (sql.Error, CTIPError):
+            self.conn.rollback()
+            raise
+        finally:
+            self.conn.isolation_level = isolation_level
+
+    def schemaVersion(self):
+        return self.conn.execute("PRAGMA user_version").fetchone()[0]
 
     def __del__(self):
         self.conn.close()
 
-    def newSession(self, config_group, session_name, datetime, whereClause=""):
-        cur = self.conn.cursor()
+    def commit(self):
+        """Commit the current transaction unless a batch is in progress."""
+        if not self.batching:
+            self.conn.commit()
+
+    @contextmanager
+    def batch(self):
+        """Make every write inside the block part of one transaction."""
+        self.batching = True
+        try:
+            yield
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+        finally:
+            self.batching = False
+
+    @retryOnLock
+    def newSession(self, config_group, session_name, datetime, whereClause="",
+                   outdir=None, qsub=None, mode=None, settings=None):
+        """
+        Add a session. 'settings' maps more sessions columns (like the
+        bundle_* ones) to the values its executor needs to resume it.
+        """
+        values = OrderedDict([('name', session_name), ('config_group', config_group),
+                              ('date', datetime), ('outdir', outdir), ('qsub', qsub),
+                              ('mode', mode)])
         if whereClause:
-            s = "INSERT INTO sessions(name, config_group, where_clause, date) values(?,?,?,?)"
-            cur.execute(s, (session_name, config_group, whereClause, datetime))
-        else:
-            s = "INSERT INTO sessions(name, config_group, date) values(?,?,?)"
-            cur.execute(s, (session_name, config_group, datetime))
+            values['where_clause'] = whereClause
+        values.update(settings or {})
+        s = "INSERT INTO sessions({0}) values({1})".format(
+                ','.join(values.keys()), ','.join(['?'] * len(values)))
+        cur = self.conn.cursor()
+        cur.execute(s, values.values())
 
         new_session_id = cur.lastrowid
-        self.conn.commit()
+        self.commit()
         return new_session_id
 
+    @retryOnLock
     def addJobToSession(self, session_id, config_id, job_id):
         s = "INSERT INTO jobs(session_id,config_id,job_id,status) values(?,?,?,?)"
         self.conn.execute(s, (session_id, config_id, job_id, "submitted"))
-        self.conn.commit()
+        self.commit()
+
+    @retryOnLock
+    def addJobsToSession(self, session_id, jobs):
+        """
+        Record many (config_id, job_id[, retry_of, attempt, config_hash,
+        run_dir]) jobs in a single transaction. Jobs that are already
+        recorded are left as they are.
+        """
+        s = """INSERT OR IGNORE INTO jobs(session_id,config_id,job_id,status,retry_of,attempt,
+                                          config_hash,run_dir)
+               values(?,?,?,?,?,?,?,?)"""
+        rows = []
+        for job in jobs:
+            retry_of,attempt,config_hash,run_dir = (tuple(job[2:]) + (None, 1, None, None)[len(job) - 2:])
+            rows.append((session_id, job[0], job[1], "submitted", retry_of, attempt,
+                         config_hash, run_dir))
+        self.conn.executemany(s, rows)
+        self.commit()
+
+    def getCachedResults(self, config_hashes):
+        """
+        Get {config_hash: (job_id, run_dir)} for the given config hashes
+        that a job has already finished successfully.
+        """
+        cached = {}
+        for page in chunks(config_hashes, 500):
+            s = """
+            SELECT config_hash, job_id, run_dir FROM jobs
+            WHERE status = 'done' AND run_dir IS NOT NULL AND config_hash IN ({0})
+            """.format(','.join('?' * len(page)))
+            for config_hash,job_id,run_dir in self.conn.execute(s, page):
+                cached[config_hash] = (job_id, run_dir)
+        return cached
+
+    @retryOnLock
+    def addCachedJobs(self, session_id, jobs):
+        """
+        Record many (config_id, job_id, config_hash, run_dir) jobs whose
+        results were reused from an earlier session as done.
+        """
+        s = """INSERT OR IGNORE INTO jobs(session_id,config_id,job_id,status,config_hash,run_dir)
+               values(?,?,?,'done',?,?)"""
+        self.conn.executemany(s, [(session_id,) + tuple(job) for job in jobs])
+        self.commit()
 
+    @retryOnLock
     def updateJobStatus(self, job_id, status):
         job_id = job_id.split('.')[0]
         s = "UPDATE jobs SET status = ? WHERE job_id = ?"
         cur = self.conn.cursor()
         cur.execute(s, (status, job_id))
-        self.conn.commit()
+        self.commit()
         if cur.rowcount == 0:
             raise CTIPError("Invalid job id: {0}".format(job_id))
 
-    def startJob(self, job_id):
-        job_id = job_id.split('.')[0]
-        s = "UPDATE jobs SET time_log = datetime('now') WHERE job_id = ?"
-        self.conn.execute(s, (job_id,))
-        self.conn.commit()
+    def getSession(self, session_id):
+        """Get the sessions table record of a session, or None."""
+        s = "SELECT * FROM sessions WHERE id = ?"
+        return self.conn.execute(s, (session_id,)).fetchone()
 
-    def pauseJob(self, job_id):
-        self.incRuntime(job_id)
-        self.conn.commit()
+    def getSessionConfigIds(self, session_id, finished_only=False):
+        """Get the set of config ids that have a job in a session."""
+        # Older sessions stored '<id>_<tag>' run names as config ids
+        s = "SELECT DISTINCT CAST(config_id AS INTEGER) FROM jobs WHERE session_id = ?"
+        if finished_only:
+            s += " AND status IN ('done', 'error')"
+        return set(row[0] for row in self.conn.execute(s, (session_id,)))
 
-    def resumeJob(self, job_id):
-        self.startJob(job_id)
+    def getFailedJobs(self, session_id):
+        """
+        Get the latest job of every config in a session that has neither
+        finished successfully nor been retried yet.
+        """
+        s = """
+        SELECT CAST(config_id AS INTEGER) AS config_id, job_id, status, attempt, run_dir
+        FROM jobs j
+        WHERE session_id = ? AND status != 'done'
+          AND NOT EXISTS (SELECT 1 FROM jobs r
+                          WHERE r.session_id = j.session_id AND r.retry_of = j.job_id)
+          AND NOT EXISTS (SELECT 1 FROM jobs d
+                          WHERE d.session_id = j.session_id AND d.config_id = j.config_id
+                            AND d.status = 'done')
+        """
+        return self.conn.execute(s, (session_id,)).fetchall()
+
+    def getFailureCounts(self, session_id):
+        """Get {config_id: {failure: count}} for the failed jobs of a session."""
+        s = """
+        SELECT CAST(config_id AS INTEGER), failure, count(*) FROM jobs
+        WHERE session_id = ? AND failure IS NOT NULL
+        GROUP BY config_id, failure
+        """
+        counts = {}
+        for config_id,failure,count in self.conn.execute(s, (session_id,)):
+            counts.setdefault(config_id, {})[failure] = count
+        return counts
+
+    @retryOnLock
+    def setJobFailures(self, session_id, failures):
+        """Mark many (job_id, failure) pairs of a session as failed."""
+        s = "UPDATE jobs SET status = 'error', failure = ? WHERE session_id = ? AND job_id = ?"
+        self.conn.executemany(s, [(failure, session_id, job_id)
+                                  for job_id,failure in failures])
+        self.commit()
+
+    def getJobIds(self):
+        """Get the set of every job id in the jobs table."""
+        return set(str(row[0]) for row in self.conn.execute("SELECT job_id FROM jobs"))
+
+    def getActiveJobIds(self, session_id=None, scheduled=False, mode=None):
+        """
+        Get the set of job ids that haven't finished, of one session or
+        all. With 'scheduled', only jobs submitted to the scheduler (not
+        run by a local session) are included, and with 'mode' only the
+        jobs of sessions run in that mode.
+        """
+        s = "SELECT job_id FROM jobs WHERE status NOT IN ('done', 'error', 'lost')"
+        if scheduled:
+            s += " AND session_id IN (SELECT id FROM sessions WHERE mode IS NOT 'local')"
+        params = []
+        if mode:
+            s += " AND session_id IN (SELECT id FROM sessions WHERE mode = ?)"
+            params.append(mode)
+        if session_id:
+            s += " AND session_id = ?"
+            params.append(session_id)
+        rows = self.conn.execute(s, params)
+        return set(str(row[0]) for row in rows)
+
+    @retryOnLock
+    def setJobStatuses(self, job_stats):
+        """
+        Apply many (job_id, status) pairs in a single transaction,
+        leaving jobs that already finished alone. Returns the number of
+        jobs whose status actually changed.
+        """
+        cur = self.conn.cursor()
+        cur.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS job_status_sync(
+                job_id TEXT PRIMARY KEY,
+                status TEXT
+            )
+        """)
+        cur.execute("DELETE FROM job_status_sync")
+        cur.executemany("INSERT OR REPLACE INTO job_status_sync values(?,?)", job_stats)
+        cur.execute("""
+        UPDATE jobs SET status = (
+            SELECT s.status FROM job_status_sync s WHERE s.job_id = jobs.job_id
+        ) WHERE job_id IN (SELECT job_id FROM job_status_sync)
+            AND status NOT IN ('done', 'error')
+            AND status IS NOT (
+                SELECT s.status FROM job_status_sync s WHERE s.job_id = jobs.job_id
+            )
+        """)
+        changed = cur.rowcount
+        self.commit()
+        return changed
 
-    def endJob(self, job_id):
-        self.incRuntime(job_id)
+    @retryOnLock
+    def startJob(self, job_id, timestamp=None):
         job_id = job_id.split('.')[0]
-        s = "UPDATE jobs SET time_log = NULL WHERE job_id = ?"
+        # A job that starts again without stopping ran until now
+        self.incRuntime(job_id, timestamp)
+        s = "UPDATE jobs SET time_log = COALESCE(?, datetime('now')) WHERE job_id = ?"
+        self.conn.execute(s, (timestamp, job_id))
+        s = """
+        INSERT INTO job_intervals(session_id, job_id, start)
+            SELECT session_id, job_id, time_log FROM jobs WHERE job_id = ?
+        """
         self.conn.execute(s, (job_id,))
-        self.conn.commit()
+        self.commit()
+
+    @retryOnLock
+    def pauseJob(self, job_id, timestamp=None):
+        self.incRuntime(job_id, timestamp)
+        self.commit()
+
+    def resumeJob(self, job_id, timestamp=None):
+        self.startJob(job_id, timestamp)
 
-    def incRuntime(self, job_id):
+    @retryOnLock
+    def endJob(self, job_id, timestamp=None):
+        self.incRuntime(job_id, timestamp)
+        self.commit()
+
+    def incRuntime(self, job_id, timestamp=None):
+        """
+        Close the job's running interval, if it has one, and add its
+        length to the job's runtime.
+        """
         job_id = job_id.split('.')[0]
         s = """
-        UPDATE jobs SET runtime = (
-            SELECT CAST((
-                strftime('%s', datetime('now')) -
-                strftime('%s', (SELECT time_log FROM jobs
-                                WHERE job_id = :id))
-            ) AS TEXT)
-        ) WHERE job_id = :id
+        UPDATE jobs SET
+            runtime_seconds = COALESCE(runtime_seconds, 0) + MAX(0,
+                strftime('%s', COALESCE(:now, datetime('now'))) - strftime('%s', time_log)),
+            time_log = NULL
+        WHERE job_id = :id AND time_log IS NOT NULL
+        """
+        self.conn.execute(s, {"id": job_id, "now": timestamp})
+        s = "UPDATE jobs SET runtime = CAST(runtime_seconds AS TEXT) WHERE job_id = ?"
+        self.conn.execute(s, (job_id,))
+        s = """
+        UPDATE job_intervals SET end = COALESCE(?, datetime('now'))
+        WHERE job_id = ? AND end IS NULL
+        """
+        self.conn.execute(s, (timestamp, job_id))
+
+    @retryOnLock
+    def finishJob(self, job_id, status, start, end, run_dir=None):
+        """
+        Record the start and end time of a job that ctip ran itself,
+        unless the job logged its own start (then only an interval it
+        left open is closed at 'end'). 'status' is only stored if the
+        job didn't report one of its own.
+        """
+        with self.batch():
+            s = "SELECT 1 FROM job_intervals WHERE job_id = ? LIMIT 1"
+            if self.conn.execute(s, (job_id.split('.')[0],)).fetchone() is None:
+                self.startJob(job_id, start)
+            self.endJob(job_id, end)
+            s = "UPDATE jobs SET status = ? WHERE job_id = ? AND status NOT IN ('done', 'error')"
+            self.conn.execute(s, (status, job_id))
+            s = "UPDATE jobs SET run_dir = COALESCE(?, run_dir) WHERE job_id = ?"
+            self.conn.execute(s, (run_dir, job_id))
+
+    @retryOnLock
+    def applyJobEvents(self, events, offsets):
+        """
+        Apply (timestamp, job_id, event, value) records read from job
+        event journals, and the journal offsets they were read up to,
+        in a single transaction. Returns the number of events applied.
         """
-        self.conn.execute(s, {"id": job_id})
+        applied = 0
+        with self.batch():
+            for timestamp,job_id,event,value in events:
+                try:
+                    if event == 'start':
+                        self.startJob(job_id, timestamp)
+                    elif event == 'pause':
+                        self.pauseJob(job_id, timestamp)
+                    elif event == 'resume':
+                        self.resumeJob(job_id, timestamp)
+                    elif event == 'end':
+                        self.endJob(job_id, timestamp)
+                    elif event == 'status':
+                        self.updateJobStatus(job_id, value)
+                    elif event == 'id':
+                        self.updateJobId(job_id, value)
+                    else:
+                        continue
+                except CTIPError:
+                    # Events for jobs that were cleaned up are dropped
+                    continue
+                applied += 1
 
+            s = "INSERT OR REPLACE INTO journal_offsets(path, byte_offset) values(?,?)"
+            self.conn.executemany(s, offsets.items())
+
+        return applied
+
+    def getJournalOffsets(self):
+        """Get how far each journal file has been ingested, keyed by path."""
+        s = "SELECT path, byte_offset FROM journal_offsets"
+        return dict((row[0], row[1]) for row in self.conn.execute(s))
+
+    def getSessionOutdirs(self, session_id=None):
+        """Get (id, outdir) for every session, or only the given one."""
+        s = "SELECT id, outdir FROM sessions WHERE outdir IS NOT NULL"
+        if session_id:
+            return self.conn.execute(s + " AND id = ?", (session_id,)).fetchall()
+        return self.conn.execute(s).fetchall()
+
+    @retryOnLock
     def updateJobId(self, job_id, new_id):
         job_id = job_id.split('.')[0]
         s = "UPDATE jobs SET job_id = ? WHERE job_id = ?"
         cur = self.conn.cursor()
         cur.execute(s, (new_id, job_id))
-        self.conn.commit()
+        s = "UPDATE job_intervals SET job_id = ? WHERE job_id = ?"
+        self.conn.execute(s, (new_id, job_id))
+        self.commit()
         if cur.rowcount == 0:
             raise CTIPError("Invalid job id: {0}".format(job_id))
 
-    def deleteFinishedSessions(self):
-        cols,sessions = self.getRecords("sessions")
-
-        finished_sessions = []
-        query = "SELECT * from jobs WHERE session_id=? and status!='done'"
-        for session in sessions:
-            unfinished = self.conn.execute(query, (session['id'],))
-            if not unfinished.fetchall():
-                finished_sessions.append(session)
+    def getFinishedSessions(self, older_than=None):
+        """
+        Get the sessions whose jobs have all finished successfully, not
+        counting jobs that were retried, and optionally only those
+        started more than 'older_than' days ago.
+        """
+        s = """
+        SELECT * FROM sessions s
+        WHERE NOT EXISTS (
+            SELECT 1 FROM jobs j
+            WHERE j.session_id = s.id AND j.status != 'done'
+              AND NOT EXISTS (SELECT 1 FROM jobs r
+                              WHERE r.session_id = j.session_id AND r.retry_of = j.job_id)
+        )
+        """
+        params = ()
+        if older_than is not None:
+            s += " AND s.date < datetime('now', 'localtime', ?)"
+            params = ("-{0} days".format(older_than),)
+        return self.conn.execute(s + " ORDER BY s.id", params).fetchall()
 
-        print("Sessions deleted:")
-        for session in finished_sessions:
-            print(session)
-            self.deleteSession(session['id'])
+    def deleteFinishedSessions(self, older_than=None):
+        """Delete every finished session, returning the sessions deleted."""
+        sessions = self.getFinishedSessions(older_than)
+        self.deleteSessions([session['id'] for session in sessions])
+        return sessions
 
     def deleteSession(self, session_id):
-        s = "DELETE FROM jobs WHERE session_id = ?"
-        self.conn.execute(s, (session_id,))
-        s = "DELETE FROM sessions WHERE id = ?"
-        self.conn.execute(s, (session_id,))
-        self.conn.commit()
+        self.deleteSessions([session_id])
+
+    @retryOnLock
+    def deleteSessions(self, session_ids):
+        """
+        Delete many sessions, with their jobs, job intervals and journal
+        offsets, in a single transaction. Journal offsets are kept while
+        a session that isn't deleted shares the output directory.
+        """
+        cur = self.conn.cursor()
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS session_clean(id INTEGER PRIMARY KEY)")
+        cur.execute("DELETE FROM session_clean")
+        cur.executemany("INSERT OR IGNORE INTO session_clean values(?)",
+                        [(id,) for id in session_ids])
+        cur.execute("""
+        DELETE FROM journal_offsets WHERE EXISTS (
+            SELECT 1 FROM sessions s
+            WHERE s.id IN (SELECT id FROM session_clean) AND s.outdir IS NOT NULL
+              AND substr(journal_offsets.path, 1, length(s.outdir) + 1) = s.outdir || '/'
+              AND NOT EXISTS (
+                SELECT 1 FROM sessions k
+                WHERE k.outdir = s.outdir AND k.id NOT IN (SELECT id FROM session_clean)
+              )
+        )
+        """)
+        for table,column in (('job_intervals', 'session_id'), ('jobs', 'session_id'),
+                             ('sessions', 'id')):
+            cur.execute("DELETE FROM {0} WHERE {1} IN (SELECT id FROM session_clean)".format(
+                table, column))
+        self.commit()
+
+    def vacuum(self):
+        """
+        Give the space freed by deletes back to the filesystem, with an
+        incremental vacuum if the database was set up for them.
+        """
+        if self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            self.conn.execute("PRAGMA incremental_vacuum").fetchall()
+        else:
+            self.conn.execute("VACUUM")
 
     def listConfigTables(self):
         """List the names of all config tables in the database."""
@@ -138,47 +614,95 @@ class DatabaseManager:
             if row[0] not in self.reserved_table_names:
                 print(row[0])
 
-    def printTable(self, table, where=''):
-        """Print the records from a specific table in a pretty format."""
-        colnames,records = self.getRecords(table, where)
-        printrows = [colnames]
+    def printTable(self, table, where='', limit=None, offset=0, format='table',
+                   out=sys.stdout):
+        """
+        Print the records from a specific table in a pretty format, or as
+        csv, tsv or json, one record at a time as they are read.
+        """
+        query = "SELECT * FROM (SELECT * FROM {0} {1}) LIMIT ? OFFSET ?".format(table, where)
+        params = (-1 if limit is None else limit, offset)
+        cur = self.conn.execute(query, params)
+        colnames = [cn[0] for cn in cur.description]
 
-        for row in records:
-            strlist = []
-            for e in row:
-                strlist.append(str(e))
-            printrows.append(strlist)
+        if format in ('csv', 'tsv'):
+            writer = csv.writer(out, delimiter=',' if format == 'csv' else '\t',
+                                lineterminator='\n')
+            writer.writerow(colnames)
+            for row in cur:
+                writer.writerow(list(row))
+        elif format == 'json':
+            # A json list with one record per line, so it can still be grepped
+            out.write("[")
+            sep = "\n"
+            for row in cur:
+                out.write(sep + json.dumps(OrderedDict(zip(colnames, row))))
+                sep = ",\n"
+            out.write("\n]\n")
+        else:
+            # Let sqlite find the column widths instead of holding every row
+            lengths = ','.join("max(length(COALESCE({0}, 'None')))".format(name)
+                               for name in colnames)
+            widths = self.conn.execute("SELECT {0} FROM ({1})".format(lengths, query),
+                                       params).fetchone()
+            line_format = ' '.join("{{{0}:<{1}}}".format(i, max(len(name), width or 0))
+                                   for i,(name,width) in enumerate(zip(colnames, widths)))
+            line_format = unicode(line_format) + u"\n"
+            out.write(line_format.format(*colnames).encode('utf-8'))
+            for row in cur:
+                out.write(line_format.format(*[unicode(e) for e in row]).encode('utf-8'))
 
-        widths = []
-        for i in range(len(printrows[0])):
-            widths.append(0)
-            for j in range(len(printrows)):
-                width = len(printrows[j][i])+1
-                if width > widths[i]:
-                    widths[i] = width
+    def getRecords(self, table, whereClause=""):
 
-        printstr = ""
-        for w in widths:
-            printstr += "%-" + str(w) + "s "
+        colnames,cur = self.queryRecords(table, whereClause)
 
-        for row in printrows:
-            print(printstr.format(tuple(row)))
+        # Get the relevant configurations
+        #   -> if whereClause is "", get all the configs in the table
+        records = cur.fetchall()
 
-    def getRecords(self, table, whereClause=""):
+        return colnames,records
 
+    def queryRecords(self, table, whereClause=""):
+        """
+        Get the column names of a table and a cursor over its records
+        that satisfy the 'whereClause', to read them one at a time.
+        """
         cur = self.conn.cursor()
         cur.execute("SELECT * FROM {0} {1}".format(table, whereClause))
 
         # Get the column names
         colnames = [cn[0] for cn in cur.description]
 
-        # Get the relevant configurations
-        #   -> if whereClause is "", get all the configs in the table
-        records = cur.fetchall()
+        return colnames,cur
 
-        return colnames,records
+    def iterRecords(self, table, whereClause="", chunk_size=ctip.CONFIG_CHUNK_SIZE):
+        """
+        Yield the records of a config table in id order, reading one
+        page of 'chunk_size' records at a time.
+        """
+        query = """
+        SELECT * FROM (SELECT * FROM {0} {1}) WHERE id > ? ORDER BY id LIMIT ?
+        """.format(table, whereClause)
+
+        last_id = float('-inf')
+        while True:
+            page = self.conn.execute(query, (last_id, chunk_size)).fetchall()
+            for record in page:
+                yield record
+            if len(page) < chunk_size:
+                return
+            last_id = page[-1]['id']
 
-    def addConfigTable(self, name, colnames, configs):
+    def addConfigTable(self, name, colnames, configs, types=None, indexes=()):
+        """
+        Create a config table and bulk load the configs into it. 'types'
+        maps column names to the sqlite affinity (INTEGER, REAL, NUMERIC
+        or TEXT) their values are stored with (columns without one store
+        them as given), and an index is created on each column in
+        'indexes' once the configs are loaded. Returns the number of
+        configs loaded and the seconds it took.
+        """
+        types = types or {}
 
         if name.lower() in self.reserved_table_names:
             raise CTIPError(name + " is a reserved table name.")
@@ -193,8 +717,10 @@ class DatabaseManager:
         # Generate the create table query
         #
         # Ensure the first column is an auto-incremented primary key
+        colnames = ["{0} {1}".format(col, types[col]) if types.get(col) else col
+                    for col in colnames]
         if alreadyHasId:
-            colnames[0] = "{0} INTEGER PRIMARY KEY".format(colnames[0])
+            colnames[0] = "{0} INTEGER PRIMARY KEY".format(colnames[0].split()[0])
         else:
             colnames.insert(0, "id INTEGER PRIMARY KEY")
         # Add the column names to the create query
@@ -211,38 +737,337 @@ class DatabaseManager:
                  createSql ]
 
         #
-        # Construct the insert template
+        # Construct the parameterized insert statement
         #
-        insertSql = "INSERT INTO {0}{1} values(".format(name,insertColNames)
-        # Ensure the id column, if present, is stored as an int
-        id_offset = 0
-        if alreadyHasId:
-            insertSql += "{0},"
-            id_offset = 1
-        for i in range(id_offset, num_cols):
-            insertSql += "'{" + str(i) + "}',"
-        insertSql = insertSql[:-1] + ');'
+        insertSql = "INSERT INTO {0}{1} values({2})".format(
+                name, insertColNames, ','.join(['?'] * num_cols))
 
         #
-        # Add an insert statement for each config
+        # Bulk load the configs a chunk at a time, one transaction per
+        # chunk, so only one chunk of configs is ever held in memory
         #
-        for config in configs:
-            sqls.append(insertSql.format(*config))
-
-        # Execute the sql statements
+        start = time.time()
+        count = 0
         cur = self.conn.cursor()
         cur.executescript("".join(sqls))
+        with self.loadPragmas():
+            for chunk in chunks(configs, ctip.CONFIG_CHUNK_SIZE):
+                rows = [configValues(config, alreadyHasId) for config in chunk]
+                cur.executemany(insertSql, rows)
+                self.conn.commit()
+                count += len(rows)
+            self.indexColumns(name, indexes)
 
-    def getSessionSummary(self, session_id=None):
+        return count, time.time() - start
+
+    def mergeConfigTable(self, name, colnames, configs, indexes=()):
+        """
+        Add the configs that aren't in an existing config table yet,
+        keeping the ids of the configs that are. Configs are matched on
+        every column but 'id' (any ids given are ignored) through a
+        unique index over those columns, and values are stored with the
+        affinity of their existing column. Returns the number of configs
+        added, the number already in the table and the seconds it took.
+        """
+        hasId = colnames[0].lower() == 'id'
+        params = colnames[1:] if hasId else colnames
+        self.checkMergeColumns(name, params)
+
+        start = time.time()
+        try:
+            self.conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS {0}_params ON {0}({1})".format(
+                name, ','.join(params)))
+        except sql.IntegrityError:
+            raise CTIPError("{0} has duplicate configs, it can't be merged into".format(name))
+
+        insertSql = "INSERT OR IGNORE INTO {0}({1}) values({2})".format(
+                name, ','.join(params), ','.join(['?'] * len(params)))
+        count = 0
+        added = 0
         cur = self.conn.cursor()
+        with self.loadPragmas():
+            for chunk in chunks(configs, ctip.CONFIG_CHUNK_SIZE):
+                rows = [configValues(config[1:] if hasId else config) for config in chunk]
+                changes = self.conn.total_changes
+                cur.executemany(insertSql, rows)
+                self.conn.commit()
+                added += self.conn.total_changes - changes
+                count += len(rows)
+            self.indexColumns(name, indexes)
+
+        return added, count - added, time.time() - start
+
+    def checkMergeColumns(self, name, params):
+        """Make sure configs with the 'params' columns can be merged into a table."""
+        existing = [row[1] for row in self.conn.execute("PRAGMA table_info({0})".format(name))]
+        if sorted(c.lower() for c in params) != sorted(c.lower() for c in existing[1:]):
+            raise CTIPError("The columns of {0} have changed, it can't be merged into".format(name))
+
+    def indexColumns(self, name, cols):
+        """
+        Create an index on each of the given columns of a config table
+        that doesn't have one yet. Returns the columns newly indexed.
+        """
+        created = []
+        for col in cols:
+            index = "{0}_{1}".format(name, col)
+            s = "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ? COLLATE NOCASE"
+            if self.conn.execute(s, (index,)).fetchone() is None:
+                self.conn.execute("CREATE INDEX {0} ON {1}({2})".format(index, name, col))
+                created.append(col)
+        self.conn.commit()
+        return created
+
+    def getWhereColumns(self, name, min_sessions):
+        """
+        Get the columns of a config table named in the where clauses of
+        at least 'min_sessions' of the sessions run on it.
+        """
+        cols = [row[1] for row in self.conn.execute("PRAGMA table_info({0})".format(name))]
+        s = """
+        SELECT where_clause FROM sessions
+        WHERE config_group = ? COLLATE NOCASE AND where_clause != ''
+        """
+        clauses = [row[0] for row in self.conn.execute(s, (name,))]
+
+        frequent = []
+        for col in cols[1:]:
+            named = re.compile(r'\b{0}\b'.format(re.escape(col)), re.IGNORECASE)
+            if sum(1 for clause in clauses if named.search(clause)) >= min_sessions:
+                frequent.append(col)
+        return frequent
+
+    def getColumnValues(self, name, cols):
+        """
+        Get the set of distinct values, as text, in each of the given
+        columns of a table, and the number of records in the table.
+        """
+        values = []
+        for col in cols:
+            s = "SELECT DISTINCT CAST({1} AS TEXT) FROM {0}".format(name, col)
+            values.append(set(row[0] for row in self.conn.execute(s)))
+        count = self.conn.execute("SELECT count(*) FROM {0}".format(name)).fetchone()[0]
+        return values,count
+
+    def getStoredText(self, name, col, values):
+        """
+        Get each of the values as text the way a column of a table
+        would store it, once the column's type affinity converts it
+        (5 in a REAL column is '5.0'), to compare with getColumnValues.
+        """
+        types = dict((row[1].lower(), row[2])
+                     for row in self.conn.execute("PRAGMA table_info({0})".format(name)))
+        self.conn.execute("DROP TABLE IF EXISTS temp.ctip_stored")
+        self.conn.execute("CREATE TEMP TABLE ctip_stored(i INTEGER PRIMARY KEY, v {0})".format(
+            types.get(col.lower(), "")))
+        self.conn.executemany("INSERT INTO temp.ctip_stored(i, v) values(?,?)", enumerate(values))
+        s = "SELECT CAST(v AS TEXT) FROM temp.ctip_stored ORDER BY i"
+        texts = [row[0] for row in self.conn.execute(s)]
+        self.conn.execute("DROP TABLE temp.ctip_stored")
+        return texts
+
+    def hasTable(self, name):
+        s = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ? COLLATE NOCASE"
+        return self.conn.execute(s, (name,)).fetchone() is not None
+
+    @contextmanager
+    def loadPragmas(self):
+        """Relax durability settings for the duration of a bulk load."""
+        journal_mode = self.conn.execute("PRAGMA journal_mode").fetchone()[0]
+        synchronous = self.conn.execute("PRAGMA synchronous").fetchone()[0]
+        # Leaving WAL mode needs exclusive access, and WAL loads fast anyway
+        if ctip.LOAD_JOURNAL_MODE and journal_mode.lower() != 'wal':
+            self.conn.execute("PRAGMA journal_mode = {0}".format(ctip.LOAD_JOURNAL_MODE))
+        if ctip.LOAD_SYNCHRONOUS:
+            self.conn.execute("PRAGMA synchronous = {0}".format(ctip.LOAD_SYNCHRONOUS))
+        try:
+            yield
+        finally:
+            self.conn.commit()
+            self.conn.execute("PRAGMA journal_mode = {0}".format(journal_mode))
+            self.conn.execute("PRAGMA synchronous = {0}".format(synchronous))
+
+    # Columns of a session summary, in order
+    summary_fields = ['id', 'name', 'config_group', 'where_clause', 'date', 'mode',
+                      'jobs', 'queued', 'running', 'done', 'error', 'lost', 'other',
+                      'progress', 'runtime_seconds']
+
+    def getSessionSummary(self, session_id=None):
+        """
+        Get the status counts, progress and total runtime of every
+        session, or only the given one, from a single grouped query.
+        Jobs that have been retried are left out of the counts, but
+        their runtime is included. 'queued' counts every job that
+        hasn't started running yet, and 'lost' every job that left qstat
+        without reporting how it ended.
+        """
+        s = """
+        SELECT s.id, s.name, s.config_group, s.where_clause, s.date, s.mode,
+            COALESCE(sum(j.job_id IS NOT NULL AND r.job_id IS NULL), 0),
+            COALESCE(sum(r.job_id IS NULL AND j.status IN
+                ('submitted', 'queued', 'held', 'suspended')), 0),
+            COALESCE(sum(r.job_id IS NULL AND j.status = 'running'), 0),
+            COALESCE(sum(r.job_id IS NULL AND j.status = 'done'), 0),
+            COALESCE(sum(r.job_id IS NULL AND j.status = 'error'), 0),
+            COALESCE(sum(r.job_id IS NULL AND j.status = 'lost'), 0),
+            COALESCE(sum(j.runtime_seconds), 0)
+        FROM sessions s
+        LEFT JOIN jobs j ON j.session_id = s.id
+        LEFT JOIN jobs r ON r.session_id = j.session_id AND r.retry_of = j.job_id
+        {0}
+        GROUP BY s.id ORDER BY s.id
+        """
         if session_id:
-            whereClause = "where id = {0}".format(session_id)
-            query = "select sessions.*, status, count() from sessions inner join jobs on id = session_id {0} group by status".format(whereClause)
-            cur.execute(query)
+            rows = self.conn.execute(s.format("WHERE s.id = ?"), (session_id,))
         else:
-            query = "select sessions.*, status, count() from sessions inner join jobs on id = session_id group by id, status"
-            cur.execute(query)
+            rows = self.conn.execute(s.format(""))
+
+        summary = []
+        for row in rows:
+            row = tuple(row)
+            jobs,queued,running,done,error,lost,runtime = row[6:]
+            other = jobs - queued - running - done - error - lost
+            progress = (done + error + lost) / float(jobs) if jobs else 0.0
+            values = row[:6] + (jobs, queued, running, done, error, lost, other,
+                                       progress, runtime)
+            summary.append(OrderedDict(zip(self.summary_fields, values)))
+        return summary
+
+    def getRuntimeStats(self, session_id, slowest=5):
+        """
+        Get the runtime aggregates of a session's jobs that have run:
+        count, total, mean, p50 and p95 seconds, and the (config_id,
+        job_id, runtime_seconds) of the 'slowest' slowest jobs.
+        """
+        s = """
+        SELECT count(*), sum(runtime_seconds), avg(runtime_seconds) FROM jobs
+        WHERE session_id = ? AND runtime_seconds > 0
+        """
+        count,total,mean = self.conn.execute(s, (session_id,)).fetchone()
+        stats = {'count': count, 'total': total or 0, 'mean': mean or 0,
+                 'p50': 0, 'p95': 0, 'slowest': []}
+        if not count:
+            return stats
+
+        # Percentiles straight off the (session_id, runtime_seconds) index
+        s = """
+        SELECT runtime_seconds FROM jobs
+        WHERE session_id = ? AND runtime_seconds > 0
+        ORDER BY runtime_seconds LIMIT 1 OFFSET ?
+        """
+        for name,fraction in (('p50', 0.5), ('p95', 0.95)):
+            offset = int(round(fraction * (count - 1)))
+            stats[name] = self.conn.execute(s, (session_id, offset)).fetchone()[0]
+
+        s = """
+        SELECT config_id, job_id, runtime_seconds FROM jobs
+        WHERE session_id = ? AND runtime_seconds > 0
+        ORDER BY runtime_seconds DESC LIMIT ?
+        """
+        stats['slowest'] = self.conn.execute(s, (session_id, slowest)).fetchall()
+        return stats
+
+
+class JobRecorder:
+    """
+    Buffers the job ids of a test session as they are submitted and
+    records them in batches, flushing every 'flush_count' jobs or every
+    'flush_seconds' seconds, whichever comes first.
+
+    If a 'log_path' is given, every job is also appended to that file
+    the moment it's added, so jobs that were submitted but not yet
+    flushed when ctip died can be recovered with recover(). Used as a
+    context manager, the recorder is closed on the way out.
+    """
+
+    def __init__(self, manager, session_id,
+            flush_count=ctip.JOB_FLUSH_COUNT,
+            flush_seconds=ctip.JOB_FLUSH_SECONDS,
+            log_path=None):
+        self.manager = manager
+        self.session_id = session_id
+        self.flush_count = flush_count
+        self.flush_seconds = flush_seconds
+        self.log_path = log_path
+        self.log = None
+        self.pending = []
+        self.recorded = 0
+        self.last_flush = time.time()
+
+    def add(self, config_id, job_id, retry_of=None, attempt=1, config_hash=None,
+            run_dir=None):
+        """
+        Add a job, the job it retries and which attempt at its config it
+        is, and its config's hash and run directory.
+        """
+        job = (config_id, job_id, retry_of, attempt, config_hash, run_dir)
+        if self.log_path:
+            if not self.log:
+                self.log = open(self.log_path, 'a')
+            self.log.write('\t'.join('' if field is None else str(field)
+                                     for field in job) + '\n')
+            self.log.flush()
+        self.pending.append(job)
+        if len(self.pending) >= self.flush_count:
+            self.flush()
+        else:
+            self.flushIfDue()
+
+    def flushIfDue(self):
+        if time.time() - self.last_flush >= self.flush_seconds:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.manager.addJobsToSession(self.session_id, self.pending)
+            self.recorded += len(self.pending)
+            self.pending = []
+        self.last_flush = time.time()
+
+    def close(self):
+        """Flush the jobs still pending and close the log file."""
+        try:
+            self.flush()
+        finally:
+            if self.log:
+                self.log.close()
+                self.log = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def recover(self):
+        """
+        Record every job in the log file that didn't make it into the
+        jobs table. Returns the number of jobs in the log.
+        """
+        if not self.log_path or not os.path.isfile(self.log_path):
+            return 0
+        jobs = []
+        with open(self.log_path, 'r') as log:
+            for line in log:
+                if line.endswith('\n'):
+                    jobs.append([field or None for field in line.rstrip('\n').split('\t')])
+        self.manager.addJobsToSession(self.session_id, jobs)
+        return len(jobs)
 
-        return cur.fetchall()
 
+def configHash(config, context=""):
+    """
+    Hash every value of a config, its id and tag included so replicate
+    configs don't share results, together with the 'context' it's run
+    in (a hash of the run config and templates, see runContext).
+    """
+    params = sorted((key, unicode(config[key])) for key in config.keys())
+    return hashlib.sha1(json.dumps([context, params])).hexdigest()
 
+def configValues(config, hasId=False):
+    """Convert a config into the values bound to a config table insert."""
+    values = [str(val) for val in config]
+    # Let sqlite assign an id to configs that were given a blank one
+    if hasId and not values[0]:
+        values[0] = None
+    return values
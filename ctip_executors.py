@@ -0,0 +1,556 @@
+#
+# Created by Aaron Beckett January, 2016
+#
+
+import os
+import re
+import sys
+import time
+import hashlib
+import signal
+import threading
+import traceback
+from subprocess import Popen, PIPE, STDOUT
+from multiprocessing import cpu_count
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
+from Queue import Queue, Empty as QueueEmpty
+
+from ctip_utils import CTIPError, chunks, parseWalltime, formatWalltime, readResources
+import ctip_constants as ctip
+from ctip_dbm import JobRecorder, configHash
+
+###########################################################
+#   Executors
+#
+#   An executor runs the configs of a test session. Every executor
+#   gets the session's configs as an iterable of records and works
+#   through them with a pool of at most 'jobs' worker threads. Job ids
+#   are recorded against the id of the config they run.
+#
+
+# File in a session's output directory that every submitted job is
+# appended to the moment it's submitted (see JobRecorder). Named after
+# the session, since sessions can share an output directory.
+SUBMISSION_LOG = "ctip_submitted.{0}.log"
+
+# Runs local jobs in their own session, so a walltime kill also kills
+# everything a run started. Without it only the run's bash is killed.
+SETSID = find_executable('setsid')
+
+class Executor:
+    """Base class for the ways ctip can run a test session's configs."""
+
+    # Stored with the session so 'ctip run resume' uses the same executor
+    mode = None
+
+    def __init__(self, func, manager, outdir="", qsub=None, jobs=ctip.SUBMIT_JOBS):
+        self.func = func
+        self.manager = manager
+        self.outdir = outdir
+        self.qsub = qsub
+        self.jobs = jobs
+        self.session_id = None
+        self.module = sys.modules.get(getattr(func, '__module__', None))
+        self.context = runContext(self.module, qsub)
+
+    def configHash(self, config):
+        """Hash a config together with the run config and templates that run it."""
+        return configHash(config, self.context)
+
+    def settings(self):
+        """Get the sessions columns, beyond mode, needed to resume a session."""
+        return {}
+
+    def runName(self, config):
+        """Get the name the run config gives a config's run (and its directory)."""
+        if hasattr(self.module, 'getRunName'):
+            return self.module.getRunName(config)
+        return defaultRunName(config)
+
+    def run(self, session_id, configs):
+        """Run the given configs as part of a session."""
+        self.session_id = session_id
+        self.execute(configs)
+
+    def execute(self, configs):
+        """
+        Hand every config to 'runOne' in the pool and each result to
+        'collect'. Executors that don't run configs one at a time
+        override this.
+        """
+        for result in self.imap(guarded(self.runOne), configs):
+            self.collect(result)
+
+    def runOne(self, config):
+        """Build the run of a config with the run config function."""
+        return self.callFunc(config)
+
+    def collect(self, result):
+        """Called with what 'runOne' returned (None if it failed)."""
+        pass
+
+    def recorder(self):
+        """Make a JobRecorder for the session that logs every submission."""
+        return JobRecorder(self.manager, self.session_id,
+                           log_path=os.path.join(self.outdir, SUBMISSION_LOG.format(self.session_id)))
+
+    def callFunc(self, config):
+        """Call the run config function for a config with the session args."""
+        if self.qsub:
+            return self.func(config, self.outdir, self.qsub)
+        return self.func(config, self.outdir)
+
+    def imap(self, func, configs):
+        """
+        Yield func(config) for every config as each call completes,
+        running at most 'jobs' calls at once. Configs are handed to the
+        pool a page at a time so they never all have to be in memory.
+        """
+        pool = ThreadPool(self.jobs)
+        try:
+            for page in chunks(configs, ctip.CONFIG_CHUNK_SIZE):
+                self.startPage(page)
+                for result in pool.imap_unordered(func, page):
+                    yield result
+        finally:
+            pool.close()
+            pool.join()
+
+    def startPage(self, page):
+        """Called with each page of configs before it's handed to the pool."""
+        pass
+
+
+def guarded(func):
+    """
+    Wrap an executor worker so a bad config prints its traceback and
+    returns None instead of stopping the rest of the session.
+    """
+    def wrapper(*args):
+        try:
+            return func(*args)
+        except (Exception, SystemExit):
+            traceback.print_exc()
+    return wrapper
+
+
+class PbsExecutor(Executor):
+    """Submits every config as its own job with the run config's runConfig."""
+
+    mode = 'pbs'
+
+    def execute(self, configs):
+        self.id_queue = Queue()
+        self.job_recorder = self.recorder()
+        with self.job_recorder:
+            Executor.execute(self, configs)
+            self.recordJobIds()
+
+    def runOne(self, config):
+        self.submit(config)
+
+    def collect(self, result):
+        self.recordJobIds()
+
+    def submit(self, config):
+        # runConfig reports (job_id, runName), record the config id instead
+        run_queue = Queue()
+        if self.qsub:
+            self.func(config, run_queue, self.outdir, self.qsub)
+        else:
+            self.func(config, run_queue, self.outdir)
+        while not run_queue.empty():
+            job_id,runName = run_queue.get()
+            self.id_queue.put( (config['id'], job_id, None, 1, self.configHash(config),
+                                os.path.abspath(os.path.join(self.outdir, runName))) )
+
+    def recordJobIds(self):
+        """Move every job waiting in the queue to the recorder."""
+        try:
+            while True:
+                self.job_recorder.add(*self.id_queue.get_nowait())
+        except QueueEmpty:
+            self.job_recorder.flushIfDue()
+
+
+class RetryExecutor(PbsExecutor):
+    """
+    Resubmits failed jobs. 'prepare' is handed every config and returns
+    the (retry_of, attempt) of the retry to submit, or None to leave the
+    config alone. Only the configs that are retried have their run
+    rebuilt with the run config's initJob, after which 'rescale' is
+    handed the config and its new qsub file.
+    """
+
+    def __init__(self, func, manager, outdir="", qsub=None, jobs=ctip.SUBMIT_JOBS,
+                 prepare=None, rescale=None):
+        PbsExecutor.__init__(self, func, manager, outdir, qsub, jobs)
+        self.prepare = prepare
+        self.rescale = rescale
+
+    def submit(self, config):
+        lineage = self.prepare(config)
+        if lineage:
+            retry_of,attempt = lineage
+            runName,run_qsub = self.callFunc(config)
+            if self.rescale:
+                self.rescale(config, run_qsub)
+            self.id_queue.put( (config['id'], submitQsub(run_qsub), retry_of, attempt,
+                                self.configHash(config),
+                                os.path.dirname(os.path.abspath(run_qsub))) )
+
+
+ARRAY_MANIFEST = "ctip_array.manifest"
+ARRAY_SCRIPT = "ctip_array.qsub"
+
+ARRAY_TEMPLATE = """#!/bin/bash -login
+{directives}
+#PBS -N ctip_array
+#PBS -j oe
+#PBS -o {outdir}
+cd ${{PBS_O_WORKDIR}}
+
+# Run the qsub file on line <array index> + 1 of the manifest
+INDEX=${{PBS_ARRAYID:-$PBS_ARRAY_INDEX}}
+RUN_QSUB=$(sed -n "$((INDEX + 1))p" {manifest} | cut -f2)
+bash "$RUN_QSUB"
+"""
+
+class ArrayExecutor(Executor):
+    """
+    Builds the files of every config's run with the run config's
+    initJob, lists their qsub files in a manifest and submits them all
+    with a single array job. Element <i> of the array runs line <i> of
+    the manifest and is recorded in the jobs table as <array_id>[<i>].
+    """
+
+    mode = 'array'
+
+    def execute(self, configs):
+        # A resumed session's array gets its own manifest, the first
+        # array may still be reading the original one
+        suffix = ""
+        attempt = 0
+        while os.path.exists(os.path.join(self.outdir, ARRAY_MANIFEST + suffix)):
+            attempt += 1
+            suffix = ".{0}".format(attempt)
+        manifestPath = os.path.abspath(os.path.join(self.outdir, ARRAY_MANIFEST + suffix))
+        count = 0
+        first_qsub = None
+        with open(manifestPath, 'w') as manifest:
+            for run in self.imap(guarded(self.initRun), configs):
+                if run:
+                    config_id,run_qsub,config_hash = run
+                    manifest.write("{0}\t{1}\t{2}\n".format(config_id, run_qsub, config_hash))
+                    first_qsub = first_qsub or run_qsub
+                    count += 1
+
+        if not count:
+            return
+
+        script = os.path.join(self.outdir, ARRAY_SCRIPT + suffix)
+        self.writeScript(script, manifestPath, first_qsub)
+        array_id = submitQsub(script, '-t', '0-{0}'.format(count - 1))
+        array_id = array_id.split('[')[0]
+
+        with self.recorder() as recorder, open(manifestPath, 'r') as manifest:
+            for index,line in enumerate(manifest):
+                config_id,run_qsub,config_hash = line.rstrip('\n').split('\t')
+                recorder.add(config_id, "{0}[{1}]".format(array_id, index),
+                             config_hash=config_hash, run_dir=os.path.dirname(run_qsub))
+
+    def initRun(self, config):
+        runName,run_qsub = self.callFunc(config)
+        return config['id'], os.path.abspath(run_qsub), self.configHash(config)
+
+    def writeScript(self, script, manifestPath, run_qsub):
+        """Write the array job's qsub file, with the runs' resource requests."""
+        with open(run_qsub, 'r') as template:
+            directives = [line.rstrip() for line in template
+                          if line.startswith('#PBS') and line.split()[1] not in
+                          ('-N', '-o', '-e', '-j', '-t')]
+        with open(script, 'w') as array_qsub:
+            array_qsub.write(ARRAY_TEMPLATE.format(
+                directives='\n'.join(directives),
+                outdir=os.path.abspath(self.outdir),
+                manifest=manifestPath))
+
+
+BUNDLE_NAME = "ctip_bundle"
+
+BUNDLE_TEMPLATE = """#!/bin/bash -login
+{directives}
+#PBS -N {name}
+#PBS -j oe
+#PBS -o {outdir}
+cd ${{PBS_O_WORKDIR}}
+
+# Run every config on a line of the manifest, {cores} at a time, as if it
+# were its own job <bundle id>_<member>, with its output in <run>.o
+export BUNDLE_ID=${{PBS_JOBID%%.*}}
+xargs -d '\\n' -n 1 -P {cores} bash -c \\
+    'run_qsub="${{0#* }}"; PBS_JOBID="${{BUNDLE_ID}}_${{0%% *}}" bash "$run_qsub" > "${{run_qsub%.*}}.o" 2>&1' \\
+    < {manifest}
+"""
+
+class BundleExecutor(Executor):
+    """
+    Builds the files of every config's run with the run config's
+    initJob and packs the runs into bundles of at most 'size' configs,
+    or of configs whose walltimes add up to at most 'walltime' seconds
+    once spread over 'cores'. Each bundle is submitted as one job that
+    asks for 'cores' cores and runs that many of its configs at a time.
+    Member <k> of bundle job <id> runs with PBS_JOBID=<id>_<k> and is
+    recorded in the jobs table as such, so its own 'ctip log' and
+    'ctip update' calls report on the config it runs.
+    """
+
+    mode = 'bundle'
+
+    def __init__(self, func, manager, outdir="", qsub=None, jobs=ctip.SUBMIT_JOBS,
+                 size=None, walltime=None, cores=ctip.BUNDLE_CORES):
+        Executor.__init__(self, func, manager, outdir, qsub, jobs)
+        self.size = size
+        self.walltime = walltime
+        self.cores = cores
+
+    def settings(self):
+        return {'bundle_size': self.size, 'bundle_walltime': self.walltime,
+                'bundle_cores': self.cores}
+
+    def execute(self, configs):
+        self.job_recorder = self.recorder()
+        self.bundle = 0
+        members = []
+        with self.job_recorder:
+            for run in self.imap(guarded(self.initRun), configs):
+                if not run:
+                    continue
+                if members and self.isFull(members + [run]):
+                    self.submit(members)
+                    members = []
+                members.append(run)
+            if members:
+                self.submit(members)
+
+    def initRun(self, config):
+        runName,run_qsub = self.callFunc(config)
+        run_qsub = os.path.abspath(run_qsub)
+        with open(run_qsub, 'r') as qsub_file:
+            resources = readResources(qsub_file.read())
+        return config['id'], run_qsub, resources, self.configHash(config)
+
+    def isFull(self, members):
+        if self.size and len(members) > self.size:
+            return True
+        if self.walltime:
+            walltime = self.bundleWalltime(members)
+            return walltime is not None and walltime > self.walltime
+        return False
+
+    def bundleWalltime(self, members):
+        """
+        Walltime in which the bundle's cores are sure to get through all
+        of its members, or None if they don't ask for one.
+        """
+        walltimes = [parseWalltime(resources['walltime'])
+                     for config_id,run_qsub,resources,config_hash in members
+                     if 'walltime' in resources]
+        if not walltimes:
+            return None
+        cores = min(self.cores, len(members))
+        if len(set(walltimes)) == 1:
+            return -(-len(walltimes) // cores) * walltimes[0]
+        longest = max(walltimes)
+        return -(-(sum(walltimes) - longest) // cores) + longest
+
+    def submit(self, members):
+        """Write a bundle's manifest and qsub file, submit it and record its members."""
+        # Resumed sessions add their bundles after the ones already written
+        while os.path.exists(self.bundlePath(".manifest")):
+            self.bundle += 1
+        manifestPath = self.bundlePath(".manifest")
+        with open(manifestPath, 'w') as manifest:
+            for k,(config_id,run_qsub,resources,config_hash) in enumerate(members):
+                manifest.write("{0} {1}\n".format(k, run_qsub))
+
+        script = self.bundlePath(".qsub")
+        self.writeScript(script, manifestPath, members)
+        bundle_id = submitQsub(script)
+        for k,(config_id,run_qsub,resources,config_hash) in enumerate(members):
+            self.job_recorder.add(config_id, "{0}_{1}".format(bundle_id, k),
+                                  config_hash=config_hash, run_dir=os.path.dirname(run_qsub))
+        self.bundle += 1
+
+    def bundlePath(self, ext):
+        return os.path.abspath(os.path.join(self.outdir,
+            "{0}.{1}{2}".format(BUNDLE_NAME, self.bundle, ext)))
+
+    def writeScript(self, script, manifestPath, members):
+        """Write a bundle's qsub file, asking for enough of everything for its members."""
+        config_id,run_qsub,resources,config_hash = members[0]
+        cores = min(self.cores, len(members))
+        resources = OrderedDict(resources)
+        walltime = self.bundleWalltime(members)
+        if walltime is not None:
+            resources['walltime'] = formatWalltime(walltime)
+        resources['nodes'] = "1:ppn={0}".format(cores)
+        for key in ('mem', 'vmem'):
+            if key in resources:
+                amount,unit = re.match(r"(\d+)(\w*)", resources[key]).groups()
+                resources[key] = "{0}{1}".format(int(amount) * cores, unit)
+
+        with open(run_qsub, 'r') as template:
+            directives = [line.rstrip() for line in template
+                          if line.startswith('#PBS') and line.split()[1] not in
+                          ('-N', '-o', '-e', '-j', '-t', '-l')]
+        directives.append("#PBS -l " + ','.join(
+            "{0}={1}".format(key, value) if value else key
+            for key,value in resources.items()))
+
+        with open(script, 'w') as bundle_qsub:
+            bundle_qsub.write(BUNDLE_TEMPLATE.format(
+                directives='\n'.join(directives),
+                name="{0}.{1}".format(BUNDLE_NAME, self.bundle),
+                outdir=os.path.abspath(self.outdir),
+                cores=cores,
+                manifest=manifestPath))
+
+
+class LocalExecutor(Executor):
+    """
+    Runs every config on this machine instead of submitting it. Each
+    run's qsub file (built by the run config's initJob) is run with
+    bash, at most 'jobs' at a time, with the PBS variables it expects
+    set and its output in <run>.o next to it. Runs can be limited to
+    'mem' megabytes of memory and 'walltime' seconds.
+    """
+
+    mode = 'local'
+
+    def __init__(self, func, manager, outdir="", qsub=None, jobs=None,
+                 mem=None, walltime=None):
+        Executor.__init__(self, func, manager, outdir, qsub,
+                          jobs or localCpuCount())
+        self.mem = mem
+        self.walltime = walltime
+
+    def startPage(self, page):
+        # Add the page's jobs to the session before they run, so the
+        # runs' own 'ctip log'/'ctip update' calls find them
+        self.manager.addJobsToSession(self.session_id,
+            [(config['id'], self.jobId(config), None, 1, self.configHash(config))
+             for config in page])
+
+    def jobId(self, config):
+        return "L{0}-{1}".format(self.session_id, config['id'])
+
+    def runOne(self, config):
+        job_id = self.jobId(config)
+        runName,run_qsub = self.callFunc(config)
+
+        env = dict(os.environ)
+        env['PBS_JOBID'] = job_id
+        env['PBS_O_WORKDIR'] = os.getcwd()
+        env['PBS_JOBNAME'] = runName
+
+        start = utcNow()
+        started = time.time()
+        with open(os.path.splitext(run_qsub)[0] + ".o", 'w') as out:
+            proc = Popen(self.command(run_qsub), stdout=out, stderr=STDOUT, env=env)
+            killed = []
+            timer = None
+            if self.walltime:
+                timer = threading.Timer(self.walltime, killGroup, (proc, killed))
+                timer.start()
+            returncode = proc.wait()
+            if timer:
+                timer.cancel()
+            if killed:
+                out.write("ctip: job killed: walltime {0} exceeded limit {1}\n".format(
+                    int(time.time() - started), self.walltime))
+        end = utcNow()
+
+        status = 'done' if returncode == 0 else 'error'
+        return job_id, status, start, end, os.path.dirname(os.path.abspath(run_qsub))
+
+    def collect(self, result):
+        if result:
+            self.manager.finishJob(*result)
+
+    def command(self, run_qsub):
+        """
+        The command a run's qsub file is run with, in its own session if
+        it can be and under a ulimit on its (virtual) memory if 'mem' is
+        set. Limits are set by the shell, nothing runs in the forked
+        child, which isn't safe from the pool's threads.
+        """
+        script = 'exec bash "$0"'
+        if self.mem:
+            script = "ulimit -v {0} && {1}".format(self.mem * 1024, script)
+        command = ['bash', '-c', script, run_qsub]
+        if SETSID:
+            command.insert(0, SETSID)
+        return command
+
+
+def runContext(module, qsub=None):
+    """
+    Hash what a config's results depend on besides its values: the qsub
+    template, the run config's source and the template files it names
+    (module level strings that are paths to files).
+    """
+    paths = [qsub] if qsub else []
+    if module is not None and getattr(module, '__file__', None):
+        paths.append(os.path.splitext(module.__file__)[0] + ".py")
+        paths.extend(value for name,value in sorted(vars(module).items())
+                     if not name.startswith('__') and isinstance(value, str)
+                        and os.path.isfile(value))
+
+    digest = hashlib.sha1()
+    for path in paths:
+        digest.update(path + '\0')
+        if os.path.isfile(path):
+            with open(path, 'rb') as template:
+                digest.update(template.read())
+    return digest.hexdigest()
+
+def defaultRunName(config):
+    """Name a run after its config's id and tag, as the example run config does."""
+    runName = str(config['id'])
+    if 'tag' in config.keys() and config['tag']:
+        runName += "_" + config['tag']
+    return runName
+
+def submitQsub(path, *options):
+    """Submit a qsub file and return the id of the job it became."""
+    proc = Popen(['qsub'] + list(options) + [path], stdout=PIPE)
+    job_id = proc.stdout.read().strip().split('.')[0]
+    proc.wait()
+    if not job_id:
+        raise CTIPError("Could not submit " + path)
+    return job_id
+
+def killGroup(proc, killed):
+    """Kill a local run and everything it started."""
+    killed.append(proc.pid)
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        # Not the leader of its own session (no setsid), kill it alone
+        try:
+            proc.kill()
+        except OSError:
+            pass
+
+def localCpuCount():
+    try:
+        return cpu_count()
+    except NotImplementedError:
+        return 1
+
+def utcNow():
+    """The current UTC time, in the format of sqlite's datetime('now')."""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
@@ -3,58 +3,159 @@
 #
 
 import os
+import re
 import csv
+import glob
+import time
+import random
+import operator
 import datetime
 from subprocess import Popen, PIPE
-from multiprocessing import Process, Queue
-from Queue import Empty as QueueEmpty
-from copy import deepcopy
+from itertools import product
+from collections import deque
 
-from ctip_utils import CTIPError, frange
+from ctip_utils import CTIPError, frange, lrange, scaleResources, chunks
 import ctip_constants as ctip
 from ctip_dbm import DatabaseManager
+from ctip_journal import journalDir, readEvents
 
 ###########################################################
 #   CTIP Functions
 #
 
-def storeSnapshot(table, outfile):
-    """Store the contents of a config table as a csv file."""
+def storeSnapshot(table, outfile, whereClause=""):
+    """
+    Store the contents of a config table, or the configs that satisfy
+    'whereClause', as a csv file. Returns the number of configs stored.
+    """
     db = DatabaseManager()
-    cols,configs = db.getRecords(table)
-    writeConfigCsv(outfile, table, cols, configs)
+    cols,configs = db.queryRecords(table, whereClause)
+    return writeConfigCsv(outfile, table, cols, configs)
     
 def writeConfigCsv(outfile, tablename, cols, configs):
-    """Write the given table info in csv format."""
+    """
+    Write the given table info in csv format, a chunk of configs at a
+    time. Returns the number of configs written.
+    """
     writer = csv.writer(outfile)
     writer.writerow([tablename])
     writer.writerow(cols)
-    for config in configs:
-        writer.writerow(list(config))
+    count = 0
+    for chunk in chunks(configs, ctip.CONFIG_CHUNK_SIZE):
+        writer.writerows(chunk)
+        count += len(chunk)
+    return count
         
-def createConfigTable(csv_file):
-    """Creates new config table from a properly formatted csv file."""
+def createConfigTable(csv_file, merge=False):
+    """
+    Creates new config table from a properly formatted csv file, or
+    with 'merge', adds its new configs to the existing table. The file
+    is read twice, once to work out the column types and once to load
+    it, so it must be seekable (a regular or gzipped file, not a pipe).
+    """
     reader = csv.reader(csv_file)
 
     configTableName = parseTableName(reader)
     
-    # Get the column names 
-    cols = next(reader)
+    # Get the column names, and the columns declared 'name:index'
+    cols,indexes = parseColumns(next(reader))
+
+    # Work out the column types from every config in a first pass over
+    # the file, a chunk at a time
+    types = dict((col, None) for col in cols)
+    for chunk in chunks(padConfigs(reader, len(cols)), ctip.CONFIG_CHUNK_SIZE):
+        for col,values in zip(cols, zip(*chunk)):
+            types[col] = columnType(values, types[col])
+
+    # Then stream the configs into the table in a second pass
+    csv_file.seek(0)
+    reader = csv.reader(csv_file)
+    parseTableName(reader)
+    next(reader)
+
+    loadConfigTable(configTableName, cols, padConfigs(reader, len(cols)), merge,
+                    types=types, indexes=indexes)
+    return configTableName
 
-    configs = []
+def padConfigs(reader, num_cols):
+    """
+    Lazily yield the configs of a csv reader, blank filling missing
+    columns and dropping values past the last column.
+    """
     for config in reader:
-        missing_cols = len(cols) - len(config)
-        for i in range(missing_cols):
-            config.append("")
-        configs.append(config)
+        config.extend([""] * (num_cols - len(config)))
+        yield config[:num_cols]
 
-    db = DatabaseManager()
-    db.addConfigTable(configTableName, cols, configs)
+def parseColumns(header):
+    """
+    Split a config file header into its column names and the names of
+    the columns declared indexed with a ':index' suffix.
+    """
+    cols = []
+    indexes = []
+    for col in header:
+        col = col.strip()
+        if col.lower().endswith(':index'):
+            col = col[:-len(':index')].strip()
+            indexes.append(col)
+        cols.append(col)
+    return cols, indexes
+
+def columnType(values, affinity=None):
+    """
+    Get the sqlite affinity (INTEGER, REAL, NUMERIC or TEXT) that stores
+    the given values as numbers wherever it can, narrowing the
+    'affinity' found for the column so far. A value is only a number if
+    it converts back to the same text, so '007' stays TEXT. A column
+    mixing integers and floats is NUMERIC (where a float like 1.0 reads
+    back as 1). Blank values are ignored, and a column with only blank
+    values has no affinity (None).
+    """
+    for value in values:
+        if affinity == 'TEXT':
+            break
+        value = str(value)
+        if not value:
+            continue
+        if isInteger(value):
+            kind = 'INTEGER'
+        elif isReal(value):
+            kind = 'REAL'
+        else:
+            kind = 'TEXT'
+        if affinity is None or affinity == kind:
+            affinity = kind
+        elif kind == 'TEXT':
+            affinity = 'TEXT'
+        else:
+            affinity = 'NUMERIC'
+    return affinity
 
-    return configTableName
+def isInteger(value):
+    """Whether a value's text is exactly an integer sqlite can store."""
+    try:
+        number = int(value)
+    except ValueError:
+        return False
+    return str(number) == value and -2**63 <= number < 2**63
+
+def isReal(value):
+    """Whether a value's text is exactly how its float is written back."""
+    try:
+        return str(float(value)) == value
+    except ValueError:
+        return False
 
-def generateConfigTable(gen_file):
-    """Generates config table from csv file of valid config parameters."""
+def generateConfigTable(gen_file, merge=False, sample=None, stride=None, lhs=None, seed=None):
+    """
+    Generates config table from csv file of valid config parameters,
+    or with 'merge', adds the new combinations to the existing table.
+    Instead of every combination, the table can get 'sample' random
+    ones, every 'stride'th one, or a latin hypercube design of 'lhs'
+    points, drawn with the random 'seed'.
+    """
+    if seed is not None and sample is None and lhs is None:
+        raise CTIPError("A seed only applies to --sample and --lhs")
     reader = csv.reader(gen_file)
     configTableName = parseTableName(reader)
 
@@ -82,29 +183,172 @@ def generateConfigTable(gen_file):
                     values.extend(vals)
                 else:
                     values.append(token)
-            colDict[key] = values
-
-    configs = []
-    for col in cols:
-        configs = generateCombos(configs, colDict[col])
+            colDict[key.split(':')[0].strip()] = values
+
+    cols,indexes = parseColumns(cols)
+    value_lists = [colDict[col] for col in cols]
+    types = dict((col, columnType(values)) for col,values in zip(cols, value_lists))
+    configs = generateCombos(value_lists)
+    total = None
+
+    sampled = sample is not None or stride is not None or lhs is not None
+    if sampled:
+        size = productSize(value_lists)
+        if sample is not None:
+            combos = sampleCombos(value_lists, sample, seed)
+            count = len(combos)
+        elif stride is not None:
+            combos = strideCombos(value_lists, stride)
+            count = (size + stride - 1) // stride
+        else:
+            combos = latinHypercube(value_lists, lhs, seed)
+            count = len(combos)
+        configs = (decodeCombo(value_lists, i) for i in combos)
+        print("Sampled {0} of {1} configs".format(count, size))
 
+    # A table that holds every combination of its column values only
+    # needs the combinations with a value it doesn't have yet
     db = DatabaseManager()
-    db.addConfigTable(configTableName, cols, configs)
-
+    if merge and not sampled and db.hasTable(configTableName):
+        db.checkMergeColumns(configTableName, cols)
+        domains,count = db.getColumnValues(configTableName, cols)
+        if count == productSize(domains):
+            texts = [db.getStoredText(configTableName, col, values)
+                     for col,values in zip(cols, value_lists)]
+            configs = generateNewCombos(value_lists, domains, texts)
+            total = productSize(value_lists)
+
+    loadConfigTable(configTableName, cols, configs, merge, total, types, indexes)
     return configTableName
 
-def generateCombos(combos, vals):
-    new_combos = []
-    if not combos:
-        for val in vals:
-            new_combos.append([val])
+def generateCombos(value_lists):
+    """Lazily yield every combination of the given parameter values."""
+    for combo in product(*value_lists):
+        yield combo
+
+def productSize(value_lists):
+    """Get the number of combinations of the given parameter values."""
+    return reduce(operator.mul, [len(values) for values in value_lists], 1)
+
+def decodeCombo(value_lists, index):
+    """
+    Get the combination at 'index' in the order generateCombos yields
+    them, by reading the index as a mixed radix number whose digits are
+    positions in each parameter's values (the last one changing fastest).
+    """
+    combo = [None] * len(value_lists)
+    for i in range(len(value_lists) - 1, -1, -1):
+        index,digit = divmod(index, len(value_lists[i]))
+        combo[i] = value_lists[i][digit]
+    return combo
+
+def encodeCombo(value_lists, digits):
+    """Get the index of the combination with the given value positions."""
+    index = 0
+    for values,digit in zip(value_lists, digits):
+        index = index * len(values) + digit
+    return index
+
+def sampleCombos(value_lists, count, seed=None):
+    """
+    Get the sorted indices of 'count' combinations picked at random,
+    without repeats, from every combination of the parameter values.
+    """
+    if count < 1:
+        raise CTIPError("A sample needs at least 1 config")
+    size = productSize(value_lists)
+    if count > size:
+        raise CTIPError("Can't sample {0} configs from only {1}".format(count, size))
+    rand = random.Random(seed)
+    picked = set()
+    while len(picked) < count:
+        picked.add(rand.randrange(size))
+    return sorted(picked)
+
+def strideCombos(value_lists, stride):
+    """
+    Get the index of every 'stride'th combination of the parameter
+    values, lazily and without xrange, since the number of combinations
+    can be past what xrange takes.
+    """
+    if stride < 1:
+        raise CTIPError("The stride must be at least 1")
+    return lrange(0, productSize(value_lists), stride)
+
+def latinHypercube(value_lists, count, seed=None):
+    """
+    Get the sorted indices of a latin hypercube design of 'count'
+    points. Each parameter's values are split into 'count' equal strata
+    and every stratum of every parameter is used by exactly one point,
+    paired up at random. Points that land on the same combination (when
+    a parameter has fewer values than points) are only kept once.
+    """
+    if count < 1:
+        raise CTIPError("A latin hypercube needs at least 1 point")
+    rand = random.Random(seed)
+    columns = []
+    for values in value_lists:
+        width = len(values) / float(count)
+        digits = [min(int((stratum + rand.random()) * width), len(values) - 1)
+                  for stratum in range(count)]
+        rand.shuffle(digits)
+        columns.append(digits)
+    return sorted(set(encodeCombo(value_lists, digits) for digits in zip(*columns)))
+
+def generateNewCombos(value_lists, domains, texts=None):
+    """
+    Lazily yield every combination of the given parameter values that
+    has at least one value not in that parameter's domain (a set of
+    values as text). 'texts' are the values as the table stores them
+    as text, str() of them if not given. Combinations are grouped by
+    their first new value, so none is yielded twice.
+    """
+    if texts is None:
+        texts = [[str(v) for v in values] for values in value_lists]
+    old = [[v for v,text in zip(values, keys) if text in domain]
+           for values,keys,domain in zip(value_lists, texts, domains)]
+    new = [[v for v,text in zip(values, keys) if text not in domain]
+           for values,keys,domain in zip(value_lists, texts, domains)]
+    for i in range(len(value_lists)):
+        if new[i]:
+            for combo in product(*(old[:i] + [new[i]] + value_lists[i+1:])):
+                yield combo
+
+def loadConfigTable(table, cols, configs, merge=False, total=None, types=None, indexes=()):
+    """
+    Load configs into a new table, or merge them into an existing one.
+    'total' is the number of configs in the file, if only some of them
+    are given. A new table's columns get the affinities in 'types', and
+    the columns in 'indexes' are indexed.
+    """
+    db = DatabaseManager()
+    if merge and db.hasTable(table):
+        added,unchanged,seconds = db.mergeConfigTable(table, cols, configs, indexes)
+        if total is not None:
+            unchanged = total - added
+        print("Merged configs into {0} in {1:.2f}s: {2} added, {3} unchanged".format(
+            table, seconds, added, unchanged))
     else:
-        for combo in combos:
-            for val in vals:
-                new_combo = deepcopy(combo)
-                new_combo.append(val)
-                new_combos.append(new_combo)
-    return new_combos
+        count,seconds = db.addConfigTable(table, cols, configs, types, indexes)
+        reportLoad(table, count, seconds)
+    indexWhereColumns(db, table)
+
+def indexWhereColumns(manager, table):
+    """
+    Index the columns of a config table that the where clauses of its
+    sessions filter on often.
+    """
+    cols = manager.getWhereColumns(table, ctip.AUTO_INDEX_SESSIONS)
+    created = manager.indexColumns(table, cols)
+    if created:
+        print("Indexed {0} on {1}, often used in where clauses".format(
+            ', '.join(created), table))
+
+def reportLoad(table, count, seconds):
+    """Print how many configs were loaded into a table and how fast."""
+    rate = count / seconds if seconds > 0 else float(count)
+    print("Loaded {0} configs into {1} in {2:.2f}s ({3:.0f} rows/s)".format(
+        count, table, seconds, rate))
 
 def parseTableName(reader):
     """Get the name of the config table represented in the csv file."""
@@ -122,16 +366,33 @@ def parseTableName(reader):
 
     return configTableName
 
-def initTestSession(test_func, table, whereClause="", outdir="", qsub=None, name=None):
+def initTestSession(executor, table, whereClause="", outdir="", qsub=None, name=None,
+                    check_func=None, force=False):
     """
     Initialize a test session of all configs in 'table' that satisfy
-    the 'whereClause'.
+    the 'whereClause'. Configs that a job of any session has already
+    finished are not run again unless 'force' is set. Returns the number
+    of configs that were skipped.
+
+    The configs are run by executor(manager, outdir, qsub), an Executor
+    from ctip_executors (usually partially applied to the run config
+    function it uses).
     """
 
     manager = DatabaseManager()
+    indexWhereColumns(manager, table)
 
-    # Get configs from the database
-    colnames,configs = manager.getRecords(table, whereClause)
+    # Get the config columns from the database
+    colnames,cursor = manager.queryRecords(table, whereClause)
+    cursor.close()
+
+    # Make sure the run config can fill its templates from these configs
+    # before any directory or job is created
+    if check_func:
+        if qsub:
+            check_func(colnames, qsub)
+        else:
+            check_func(colnames)
 
     #
     # Create a folder for this test session based on the date and time
@@ -162,72 +423,369 @@ def initTestSession(test_func, table, whereClause="", outdir="", qsub=None, name
     # Store text file snapshot of config table at root session dir
     snapshotPath = os.path.join(testBatchDir, table + ".csv")
     with open(snapshotPath, 'w') as sf:
-        writeConfigCsv(sf, table, colnames, configs)
+        storeSnapshot(table, sf, whereClause)
+
+    # Create the directory jobs can journal their events to
+    journal = journalDir(testBatchDir)
+    if not os.path.isdir(journal):
+        os.makedirs(journal)
+
+    # Add this session info, and how to resume it, to the sessions table
+    testBatchDir = os.path.abspath(testBatchDir)
+    executor = executor(manager, testBatchDir, qsub)
+    session_id = manager.newSession(table, name, sql_datetime_str, whereClause,
+                                    testBatchDir, qsub, executor.mode, executor.settings())
+
+    # Run every config
+    configs = manager.iterRecords(table, whereClause)
+    skipped = [0]
+    if not force:
+        configs = skipCached(executor, session_id, configs, skipped)
+    executor.run(session_id, configs)
+
+    return skipped[0]
+
+def skipCached(executor, session_id, configs, skipped):
+    """
+    Yield the configs that no job has finished yet with the executor's
+    run config and templates, a page at a time. Each config that has
+    been finished is recorded as done in this session, with a link to
+    its results at <outdir>/<run name>, and counted in skipped[0].
+    """
+    manager = executor.manager
+    for page in chunks(configs, ctip.CONFIG_CHUNK_SIZE):
+        hashes = [executor.configHash(config) for config in page]
+        cached = manager.getCachedResults(set(hashes))
+
+        jobs = []
+        for config,config_hash in zip(page, hashes):
+            if config_hash not in cached:
+                yield config
+                continue
+            job_id,run_dir = cached[config_hash]
+            link = os.path.join(executor.outdir, executor.runName(config))
+            if not os.path.lexists(link) and os.path.isdir(run_dir):
+                os.symlink(run_dir, link)
+            jobs.append( (config['id'], "C{0}-{1}".format(session_id, config['id']),
+                          config_hash, run_dir) )
+
+        if jobs:
+            manager.addCachedJobs(session_id, jobs)
+            skipped[0] += len(jobs)
+
+def resumeTestSession(executor, session_id, check_func=None):
+    """
+    Run the configs of an interrupted test session that don't have a
+    job yet (or, for local sessions, that never finished). Returns the
+    number of configs that were skipped.
+    """
+    manager = DatabaseManager()
+    session = manager.getSession(session_id)
+    if not session or not session['outdir']:
+        raise CTIPError("Session {0} can't be resumed".format(session_id))
 
-    # Add this session info to the sessions table
-    session_id = manager.newSession(table, name, sql_datetime_str, whereClause)
+    table = session['config_group']
+    whereClause = session['where_clause'] or ""
+    qsub = session['qsub']
+    outdir = session['outdir']
 
-    # Call the test_function for each config
-    jobs = []
-    id_queue = Queue()
-    for config in configs:
+    if check_func:
+        colnames,_ = manager.getRecords(table, "LIMIT 0")
         if qsub:
-            p = Process(target=test_func, args=(config, id_queue, testBatchDir, qsub))
+            check_func(colnames, qsub)
         else:
-            p = Process(target=test_func, args=(config, id_queue, testBatchDir))
-        p.start()
-        jobs.append(p)
-    for p in jobs:
-        p.join()
+            check_func(colnames)
 
-    job_ids = []
-    try:
-        while True:
-            job_ids.append(id_queue.get_nowait())
-    except QueueEmpty:
-        pass
+    # Record any job that was submitted but not recorded before the crash
+    executor = executor(manager, outdir, qsub)
+    executor.session_id = session_id
+    executor.recorder().recover()
 
-    for id,cfg_id in job_ids:
-        manager.addJobToSession(session_id, cfg_id, id)
+    skip = manager.getSessionConfigIds(session_id, executor.mode == 'local')
+    configs = (config for config in manager.iterRecords(table, whereClause)
+               if config['id'] not in skip)
+    executor.run(session_id, configs)
 
-def checkSession(session_id=None):
-    updateJobs()
+    return len(skip)
+
+def checkSession(session_id=None, sync=True, verbose=True):
+    """
+    Get the summary of every session, or only the given one. Unless
+    'sync' is False, journaled job events and the job statuses in qstat
+    are brought into the database first.
+    """
+    if sync:
+        events,seconds = ingestJournals(session_id)
+        if events and verbose:
+            print("Ingested {0} job events in {1:.2f}s".format(events, seconds))
+        changed,seconds = updateJobs()
+        if ctip.ON_HPCC and verbose:
+            print("Synced {0} job status changes from qstat in {1:.2f}s".format(
+                changed, seconds))
     manager = DatabaseManager()
     return manager.getSessionSummary(session_id)
 
+def ingestJournals(session_id=None, manager=None):
+    """
+    Fold the job events appended to session journals since the last
+    ingest into the jobs table. Returns the number of events applied
+    and the seconds the ingest took.
+    """
+    start = time.time()
+    manager = manager or DatabaseManager()
+    offsets = manager.getJournalOffsets()
+
+    # Sessions can share an output directory, read each journal once
+    journals = set(journalDir(outdir) for id,outdir in manager.getSessionOutdirs(session_id))
+
+    events = []
+    new_offsets = {}
+    for journal in sorted(journals):
+        if not os.path.isdir(journal):
+            continue
+        for name in sorted(os.listdir(journal)):
+            path = os.path.join(journal, name)
+            offset = offsets.get(path, 0)
+            if os.path.getsize(path) <= offset:
+                continue
+            records,offset = readEvents(path, offset)
+            events.extend(records)
+            new_offsets[path] = offset
+
+    applied = 0
+    if new_offsets:
+        applied = manager.applyJobEvents(events, new_offsets)
+
+    return applied, time.time() - start
+
+# Map qstat state codes to the status names stored in the jobs table
+QSTAT_STATUSES = {
+    'Q': 'queued',
+    'R': 'running',
+    'H': 'held',
+    'S': 'suspended',
+}
+
 def updateJobs():
-    if ctip.ON_HPCC:
-        # Get all job ids
-        manager = DatabaseManager()
-        colnames,jobs = manager.getRecords("jobs")
-        job_ids = []
-        for job in jobs:
-            job_ids.append(str(job['job_id']))
-
-        # Get output of qstat
-        proc = Popen(['qstat'], stdout=PIPE)
-        qstat = proc.stdout.read()
-        qstat = qstat.split('\n')
-
-        # Parse output to get the status of the active jobs
-        job_stats = []
-        for line in qstat:
-            if line:
-                line = line.split()
-                id = line[0].split('.')[0]
-                if id in job_ids:
-                    job_stats.append( ( id, line[-2] ) )
-
-        # Report the status' to the database
-        for stat in job_stats:
-            if stat[1] == 'Q':
-                manager.updateJobStatus(stat[0], 'queued')
-            elif stat[1] == 'R':
-                manager.updateJobStatus(stat[0], 'running')
-            elif stat[1] == 'H':
-                manager.updateJobStatus(stat[0], 'held')
-            elif stat[1] == 'S': 
-                manager.updateJobStatus(stat[0], 'suspended')
+    """
+    Sync the status of our active jobs with the output of qstat.
+    Returns the number of jobs whose status changed and the seconds
+    the sync took.
+    """
+    if not ctip.ON_HPCC:
+        return 0, 0.0
+
+    start = time.time()
+    manager = DatabaseManager()
+    # A finished job can still be listed by qstat while its script exits
+    job_ids = manager.getActiveJobIds(scheduled=True)
+    bundled = manager.getActiveJobIds(mode='bundle')
+
+    # Stream the output of qstat straight into one bulk update
+    #   -> '-t' lists each element of array jobs, as <id>[<index>]
+    proc = Popen(['qstat', '-t'], stdout=PIPE)
+    changed = manager.setJobStatuses(parseQstat(proc.stdout, job_ids, bundled))
+    proc.wait()
+
+    return changed, time.time() - start
+
+def watchSessions(show, session_id=None, interval=ctip.WATCH_INTERVAL):
+    """
+    Keep syncing every session, or only the given one, every 'interval'
+    seconds over one database connection until all of their jobs have
+    finished. Only jobs whose qstat status changed since the last poll
+    are written, and scheduled jobs missing from qstat for two polls in
+    a row without reporting how they ended are marked 'lost'. After
+    every poll show(summary, changed, rate, eta) is called with the
+    number of status changes, the jobs finished per minute over the
+    last WATCH_RATE_WINDOW seconds and the estimated seconds left (None
+    until there's a rate).
+    """
+    manager = DatabaseManager()
+    previous = {}
+    missing = set()
+    samples = deque()
+    while True:
+        ingestJournals(session_id, manager)
+        changed = 0
+        if ctip.ON_HPCC:
+            job_ids = manager.getActiveJobIds(session_id, scheduled=True)
+            bundled = manager.getActiveJobIds(session_id, mode='bundle')
+            proc = Popen(['qstat', '-t'], stdout=PIPE)
+            current = dict(parseQstat(proc.stdout, job_ids, bundled))
+            proc.wait()
+            transitions = [(id, status) for id,status in current.items()
+                           if previous.get(id) != status]
+            # Give a job that left qstat one poll to get its last events in
+            gone = job_ids - set(current)
+            transitions.extend((id, 'lost') for id in gone & missing)
+            missing = gone
+            if transitions:
+                changed = manager.setJobStatuses(transitions)
+            previous = current
+
+        summary = manager.getSessionSummary(session_id)
+        finished = sum(r['done'] + r['error'] + r['lost'] for r in summary)
+        remaining = sum(r['jobs'] for r in summary) - finished
+
+        now = time.time()
+        samples.append( (now, finished) )
+        while now - samples[0][0] > ctip.WATCH_RATE_WINDOW:
+            samples.popleft()
+        rate = eta = None
+        if now > samples[0][0]:
+            rate = (finished - samples[0][1]) / (now - samples[0][0]) * 60
+            if rate > 0:
+                eta = remaining / rate * 60
+
+        show(summary, changed, rate, eta)
+        if not remaining:
+            return
+        time.sleep(interval)
+
+def parseQstat(lines, job_ids, bundled=()):
+    """
+    Yield (job_id, status) for each of our jobs found in qstat output.
+    The jobs in 'bundled' are members of a bundle, <bundle id>_<k>, and
+    get the status of their bundle.
+    """
+    bundles = {}
+    for id in bundled:
+        bundles.setdefault(id.rsplit('_', 1)[0], []).append(id)
+    job_ids = set(job_ids) - set(bundled)
+
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 2 or fields[-2] not in QSTAT_STATUSES:
+            continue
+        id = fields[0].split('.')[0]
+        if id in job_ids:
+            yield id, QSTAT_STATUSES[fields[-2]]
+        for member in bundles.get(id, []):
+            yield member, QSTAT_STATUSES[fields[-2]]
 
+###########################################################
+#   Retrying Failed Jobs
+#
 
+# Output of a failed job that tells why it failed, checked in order.
+# Jobs that vanished from qstat without a status and match none of these
+# are 'lost', other failed jobs are plain 'error's.
+FAILURE_PATTERNS = [
+    ('walltime', re.compile(r"job killed: walltime \d+ exceeded limit")),
+    ('mem', re.compile(r"job killed: [pv]?mem \S+ exceeded limit|MemoryError"
+                       r"|Cannot allocate memory|std::bad_alloc|Out of memory")),
+    ('io', re.compile(r"Input/output error|Stale (NFS )?file handle"
+                      r"|Transport endpoint is not connected")),
+]
+
+def retrySession(executor, session_id, max_attempts=ctip.RETRY_ATTEMPTS,
+                 failures=ctip.RETRY_FAILURES):
+    """
+    Resubmit the configs of a session whose latest job failed, or
+    vanished from qstat, for one of the given kinds of failure. Each
+    retry asks for more of whatever its config has run out of.
+
+    The retries are submitted by executor(manager, outdir, qsub,
+    prepare=..., rescale=...), a RetryExecutor partially applied to the
+    run config's initJob. Failures are classified from the output of the
+    failed run before it's rebuilt. Returns {failure: [failed,
+    resubmitted]} for the session.
+    """
+    manager = DatabaseManager()
+    session = manager.getSession(session_id)
+    if not session or not session['outdir']:
+        raise CTIPError("Session {0} can't be retried".format(session_id))
+    if session['mode'] == 'local':
+        raise CTIPError("Local sessions can't be retried, use 'ctip run resume'")
+    outdir = session['outdir']
+
+    ingestJournals(session_id)
+    jobs = manager.getFailedJobs(session_id)
+    active = activeJobIds(set(job['job_id'] for job in jobs), session['mode'] == 'bundle')
+    failed = dict((job['config_id'], job) for job in jobs
+                  if job['status'] == 'error' or
+                     (active is not None and job['job_id'] not in active))
+    counts = manager.getFailureCounts(session_id)
+
+    report = {}
+    classified = []
+    retried = {}
+    def prepare(config):
+        job = failed[config['id']]
+        runDir = job['run_dir'] or os.path.join(outdir, executor.runName(config))
+        failure = classifyFailure(job, outputFiles(job['job_id'], runDir, outdir))
+        classified.append( (job['job_id'], failure) )
+        report.setdefault(failure, [0, 0])[0] += 1
+        if failure not in failures or job['attempt'] >= max_attempts:
+            return None
+        report[failure][1] += 1
+        retried[config['id']] = failure
+        return job['job_id'], job['attempt'] + 1
+
+    def rescale(config, run_qsub):
+        # Scale by every time this config has run out, this time included
+        seen = dict(counts.get(config['id'], {}))
+        failure = retried[config['id']]
+        seen[failure] = seen.get(failure, 0) + 1
+        with open(run_qsub, 'r') as qsub_file:
+            qsub_text = qsub_file.read()
+        with open(run_qsub, 'w') as qsub_file:
+            qsub_file.write(scaleResources(qsub_text,
+                ctip.RETRY_WALLTIME_SCALE ** seen.get('walltime', 0),
+                ctip.RETRY_MEM_SCALE ** seen.get('mem', 0)))
+
+    executor = executor(manager, outdir, session['qsub'], prepare=prepare,
+                        rescale=rescale)
+    configs = (config for config in manager.iterRecords(session['config_group'],
+                                                        session['where_clause'] or "")
+               if config['id'] in failed)
+    try:
+        executor.run(session_id, configs)
+    finally:
+        manager.setJobFailures(session_id, classified)
+
+    return report
 
+def activeJobIds(job_ids, bundled=False):
+    """
+    Get which of the given jobs qstat still lists as queued, running or
+    held, or None if there is no qstat to ask. If the jobs are 'bundled'
+    (<bundle id>_<k>) they're active as long as their bundle is.
+    """
+    if not ctip.ON_HPCC:
+        return None
+    proc = Popen(['qstat', '-t'], stdout=PIPE)
+    active = set(id for id,status in parseQstat(proc.stdout, job_ids,
+                                                 job_ids if bundled else ()))
+    proc.wait()
+    return active
+
+def outputFiles(job_id, runDir, outdir):
+    """Get the files the job run from a run directory may have written to."""
+    paths = []
+    for run_qsub in glob.glob(os.path.join(runDir, "*.qsub")):
+        with open(run_qsub, 'r') as qsub_file:
+            for line in qsub_file:
+                fields = line.split()
+                if fields[:2] == ['#PBS', '-o'] and len(fields) > 2:
+                    paths.append(fields[2])
+        paths.append(os.path.splitext(run_qsub)[0] + ".o")
+
+    # Array elements write to the array job's output, <name>.o<id>-<index>
+    if '[' in job_id:
+        array_id,index = job_id.rstrip(']').split('[')
+        paths.append(os.path.join(outdir, "ctip_array.o{0}-{1}".format(array_id, index)))
+    return paths
+
+def classifyFailure(job, paths):
+    """Work out why a failed job failed from its output files."""
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        with open(path, 'r') as output:
+            text = output.read()
+        for failure,pattern in FAILURE_PATTERNS:
+            if pattern.search(text):
+                return failure
+    return 'error' if job['status'] == 'error' else 'lost'
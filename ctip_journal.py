@@ -0,0 +1,63 @@
+#
+# Created by Aaron Beckett January, 2016
+#
+
+import os
+import time
+
+import ctip_constants as ctip
+
+###########################################################
+#   Job Event Journals
+#
+#   Jobs running on compute nodes can log their events by appending
+#   to a journal file in their session's output directory instead of
+#   writing to the ctip database. Each job appends to its own file, one
+#   tab separated line per event:
+#
+#       <utc timestamp>\t<job id>\t<event>\t<value>\n
+#
+#   'ctip ingest' (or 'ctip check') later folds the new lines of every
+#   journal file into the jobs table.
+#
+
+def journalDir(outdir):
+    """Get the job event journal directory of a test session."""
+    return os.path.abspath(os.path.join(outdir, ctip.JOURNAL_DIR))
+
+def appendEvent(journal_dir, job_id, event, value=''):
+    """Append one event record to the journal file of a job."""
+    job_id = job_id.split('.')[0]
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+    record = "{0}\t{1}\t{2}\t{3}\n".format(timestamp, job_id, event, value)
+
+    if not os.path.isdir(journal_dir):
+        try:
+            os.makedirs(journal_dir)
+        except OSError:
+            if not os.path.isdir(journal_dir):
+                raise
+
+    path = os.path.join(journal_dir, job_id + ".events")
+    with open(path, 'a') as journal:
+        journal.write(record)
+
+def readEvents(path, offset=0):
+    """
+    Read the complete event records in a journal file after 'offset'.
+    Returns the list of (timestamp, job_id, event, value) records and
+    the offset just past the last complete record.
+    """
+    with open(path, 'rb') as journal:
+        journal.seek(offset)
+        data = journal.read()
+
+    # Leave a partially written last line for the next ingest
+    end = data.rfind(b'\n') + 1
+    events = []
+    for line in data[:end].decode('utf-8').splitlines():
+        fields = line.split('\t')
+        if len(fields) == 4:
+            events.append(tuple(fields))
+
+    return events, offset + end
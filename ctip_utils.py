@@ -2,7 +2,11 @@
 # Created by Aaron Beckett January, 2016
 #
 
+import re
+import gzip
 import math
+from itertools import islice
+from collections import OrderedDict
 from string import Template
 
 ###########################################################
@@ -17,10 +21,47 @@ class CTIPError(Exception):
 class QsubBuilder(Template):
     delimiter = '%='
 
+    def keys(self):
+        """Get the names of all the %=key placeholders in the template."""
+        names = set()
+        for match in self.pattern.finditer(self.template):
+            name = match.group('named') or match.group('braced')
+            if name:
+                names.add(name)
+        return names
+
+    def check(self, keys, name="template"):
+        """Raise a CTIPError if any placeholder has no key to fill it."""
+        missing = self.keys() - set(keys)
+        if missing:
+            placeholders = ', '.join('%=' + key for key in sorted(missing))
+            raise CTIPError("No value for {0} in {1}".format(placeholders, name))
+
 ###########################################################
 #   Utility Functions
 #
 
+# Compiled templates, keyed by file path
+_templates = {}
+
+def loadTemplate(path):
+    """
+    Read and compile a template file the first time it's needed and
+    share the compiled template with every later (or threaded) caller.
+    """
+    template = _templates.get(path)
+    if template is None:
+        with open(path, 'r') as template_file:
+            template = QsubBuilder(template_file.read())
+        _templates[path] = template
+    return template
+
+def lrange(start, stop, step=1):
+    """A lazy range function that accepts python longs of any size."""
+    while start < stop:
+        yield start
+        start += step
+
 def frange(start, end=None, inc=1.0):
     """A range function that accepts both ints and floats."""
 
@@ -38,3 +79,68 @@ def frange(start, end=None, inc=1.0):
     return L
 
 
+
+def parseWalltime(walltime):
+    """Convert a [[HH:]MM:]SS walltime string to a number of seconds."""
+    if walltime is None:
+        return None
+    seconds = 0
+    try:
+        for part in str(walltime).split(':'):
+            seconds = seconds * 60 + int(part)
+    except ValueError:
+        raise CTIPError("Invalid walltime: {0}".format(walltime))
+    return seconds
+
+def formatWalltime(seconds):
+    """Convert a number of seconds to an HH:MM:SS walltime string."""
+    seconds = int(seconds)
+    return "{0:02d}:{1:02d}:{2:02d}".format(
+        seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def readResources(qsub_text):
+    """Get the key=value resources requested by the '#PBS -l' lines of a qsub file."""
+    resources = OrderedDict()
+    for line in qsub_text.splitlines():
+        fields = line.split()
+        if fields[:2] == ['#PBS', '-l'] and len(fields) > 2:
+            for resource in fields[2].split(','):
+                key,sep,value = resource.partition('=')
+                resources[key] = value
+    return resources
+
+def scaleResources(qsub_text, walltime_scale=1, mem_scale=1):
+    """
+    Multiply the walltime and memory (mem, vmem, pmem) requested by the
+    '#PBS -l' lines of a qsub file.
+    """
+    def scale(match):
+        key,value = match.group(1), match.group(2)
+        if key == 'walltime' and walltime_scale != 1:
+            value = formatWalltime(parseWalltime(value) * walltime_scale)
+        elif key != 'walltime' and mem_scale != 1:
+            amount,unit = re.match(r"(\d+)(\w*)", value).groups()
+            value = "{0}{1}".format(int(int(amount) * mem_scale), unit)
+        return "{0}={1}".format(key, value)
+
+    lines = []
+    for line in qsub_text.splitlines(True):
+        if line.startswith('#PBS') and line.split()[1:2] == ['-l']:
+            line = re.sub(r"\b(walltime|mem|vmem|pmem)=([\d:]+\w*)", scale, line)
+        lines.append(line)
+    return ''.join(lines)
+
+def openFile(path, mode='r'):
+    """Open a file, through gzip if its name ends in .gz."""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 'b', 6)
+    return open(path, mode)
+
+def chunks(iterable, size):
+    """Yield successive lists of at most 'size' items from any iterable."""
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
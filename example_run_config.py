@@ -5,7 +5,8 @@ import os, sys
 from subprocess import Popen, PIPE
 from multiprocessing import Queue
 
-from ctip_utils import QsubBuilder
+from ctip_utils import CTIPError, loadTemplate
+from ctip_journal import journalDir
 from ctip_constants import CTIP_ROOT
 
 ################################################################
@@ -17,9 +18,24 @@ templated_qsub_file = CTIP_ROOT + "example_qsub.qsub"
 def runConfig(config, queue, outdir="", qsub=templated_qsub_file):
     """Run a program using given configuration"""
 
-    # Build the directory for this run
+    runName,run_qsub = initJob(config, outdir, qsub)
+
+    #
+    # Submit the job to the scheduler using the temporary qsub file
+    #
+    proc = Popen(['qsub', run_qsub], stdout=PIPE)
+    job_id = proc.stdout.read()
+    job_id = job_id.strip().split('.')
+    queue.put( (job_id[0], runName) )
+
+
+def getRunName(config):
+    """
+    Name the run of a configuration, and its directory. ctip links to the
+    results of a config that was already run under this name too.
+    """
     try:
-        runName = str(config['id'])
+        name = str(config['id'])
     except IndexError:
         print("***ERROR***")
         print("Unable to start job, no id specified in config:")
@@ -27,11 +43,24 @@ def runConfig(config, queue, outdir="", qsub=templated_qsub_file):
     # If there is a tag column in the config, add it to the run name
     try:
         if config['tag']:
-            runName += "_" + config['tag']
+            name += "_" + config['tag']
     except IndexError:
         pass
+    return name
+
+
+def initJob(config, outdir="", qsub=templated_qsub_file):
+    """
+    Create the directory and files for a run of the given configuration.
+    Returns the name of the run and the path to its qsub file.
+    """
+
+    # Build the directory for this run
+    runName = getRunName(config)
     runDir = os.path.join(outdir, runName)
-    os.makedirs(runDir)
+    # A resumed session may already have started this run's directory
+    if not os.path.isdir(runDir):
+        os.makedirs(runDir)
 
     # Generate the config file name for this run
     cfg_file = os.path.join(runDir, runName + ".cfg")
@@ -61,7 +90,19 @@ def runConfig(config, queue, outdir="", qsub=templated_qsub_file):
     with open(cfg_file, 'w') as cfg:
         cfg.writelines(lines)
 
+    # Create the temporary qsub file from the (already compiled) qsub
+    # template using the qsub substitutions
+    subst_dict = qsubSubstitutions(config, runName, runDir, cfg_file, outdir)
+    run_qsub = os.path.join(runDir, runName + ".qsub")
+    with open(run_qsub, 'w') as temp_qsub:
+        qsub_text = loadTemplate(qsub).substitute(subst_dict)
+        temp_qsub.write(qsub_text)
+
+    return runName, run_qsub
+
 
+def qsubSubstitutions(config, runName, runDir, cfg_file, outdir):
+    """Map every key in the qsub template to its value for this run."""
 
     ################################################################
     # MAY WANT TO EDIT:
@@ -80,28 +121,23 @@ def runConfig(config, queue, outdir="", qsub=templated_qsub_file):
             # all '%=config_file' strings in the qsub template with
             # the string stored in cfg_file
             'config_file': cfg_file,
+            'journal_dir': journalDir(outdir),
             'wait_time': config['wait_time']
         }
 
     ################################################################
 
+    return subst_dict
 
 
-    # Create custom string Template from the qsub template
-    with open(qsub, 'r') as qsub_template:
-        template = QsubBuilder(qsub_template.read())
-
-    # Create the temporary qsub file from the template using subst_dict
-    run_qsub = os.path.join(runDir, runName + ".qsub")
-    with open(run_qsub, 'w') as temp_qsub:
-        qsub_text = template.substitute(subst_dict)
-        temp_qsub.write(qsub_text)
-
-    #
-    # Submit the job to the scheduler using the temporary qsub file
-    #
-    proc = Popen(['qsub', run_qsub], stdout=PIPE)
-    job_id = proc.stdout.read()
-    job_id = job_id.strip().split('.')
-    queue.put( (job_id[0], runName) )
-
+def checkConfigs(colnames, qsub=templated_qsub_file):
+    """
+    Make sure, before any job is created, that configs with the given
+    columns fill every placeholder in the qsub template.
+    """
+    config = dict((col, '') for col in colnames)
+    try:
+        subst_dict = qsubSubstitutions(config, 'run', 'run', 'run.cfg', '')
+    except KeyError as e:
+        raise CTIPError("The config table has no {0} column".format(e))
+    loadTemplate(qsub).check(subst_dict.keys(), qsub)
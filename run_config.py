@@ -5,7 +5,8 @@ import os, sys
 from subprocess import Popen, PIPE
 from multiprocessing import Queue
 
-from ctip_utils import QsubBuilder
+from ctip_utils import CTIPError, loadTemplate
+from ctip_journal import journalDir
 
 QSUB_TEMPLATE = "/mnt/home/becketta/MarkovBrain/testing/qsubTemplate.qsub"
 CFG_TEMPLATE = "/mnt/home/becketta/MarkovBrain/testing/configTemplate.cfg"
@@ -17,9 +18,24 @@ CFG_TEMPLATE = "/mnt/home/becketta/MarkovBrain/testing/configTemplate.cfg"
 def runConfig(config, queue, outdir="", qsub_file=QSUB_TEMPLATE):
     """Run a program using given configuration"""
 
-    # Build the directory for this run
+    runName,run_qsub = initJob(config, outdir, qsub_file)
+
+    #
+    # Submit the job to the scheduler using the temporary qsub file
+    #
+    proc = Popen(['qsub', run_qsub], stdout=PIPE)
+    job_id = proc.stdout.read()
+    job_id = job_id.strip().split('.')
+    queue.put( (job_id[0], runName) )
+
+
+def getRunName(config):
+    """
+    Name the run of a configuration, and its directory. ctip links to the
+    results of a config that was already run under this name too.
+    """
     try:
-        runName = str(config['id'])
+        name = str(config['id'])
     except IndexError:
         print("***ERROR***")
         print("Unable to start job, no id specified in config:")
@@ -27,15 +43,43 @@ def runConfig(config, queue, outdir="", qsub_file=QSUB_TEMPLATE):
     # If there is a tag column in the config, add it to the run name
     try:
         if config['tag']:
-            runName += "_" + config['tag']
+            name += "_" + config['tag']
     except IndexError:
         pass
-    runDir = os.path.join(outdir, runName)
-    os.makedirs(runDir)
+    return name
+
 
+def initJob(config, outdir="", qsub_file=QSUB_TEMPLATE):
+    """
+    Create the directory and files for a run of the given configuration.
+    Returns the name of the run and the path to its qsub file.
+    """
 
+    # Build the directory for this run
+    runName = getRunName(config)
+    runDir = os.path.join(outdir, runName)
+    # A resumed session may already have started this run's directory
+    if not os.path.isdir(runDir):
+        os.makedirs(runDir)
 
+    # Create the config file from the (already compiled) cfg template
     cfg_file = os.path.join(runDir, runName + ".cfg")
+    with open(cfg_file, 'w') as cfg:
+        cfg_text = loadTemplate(CFG_TEMPLATE).substitute(cfgSubstitutions(config, runDir))
+        cfg.write(cfg_text)
+
+    # Create the qsub file from the (already compiled) qsub template
+    subst_dict = qsubSubstitutions(config, runName, runDir, cfg_file, outdir)
+    run_qsub = os.path.join(runDir, runName + ".qsub")
+    with open(run_qsub, 'w') as qsub:
+        qsub_text = loadTemplate(qsub_file).substitute(subst_dict)
+        qsub.write(qsub_text)
+
+    return runName, run_qsub
+
+
+def cfgSubstitutions(config, runDir):
+    """Map every key in the cfg template to its value for this run."""
 
     ################################################################
     # EDIT CREATION OF CONFIG FILE:
@@ -56,18 +100,11 @@ def runConfig(config, queue, outdir="", qsub_file=QSUB_TEMPLATE):
 
     ################################################################
 
+    return subst_dict
 
 
-    # Create custom string Template from the cfg template
-    with open(CFG_TEMPLATE, 'r') as cfg_template:
-        template = QsubBuilder(cfg_template.read())
-
-    # Create the config file from the template using subst_dict
-    with open(cfg_file, 'w') as cfg:
-        cfg_text = template.substitute(subst_dict)
-        cfg.write(cfg_text)
-
-
+def qsubSubstitutions(config, runName, runDir, cfg_file, outdir):
+    """Map every key in the qsub template to its value for this run."""
 
     ################################################################
     # MAY WANT TO EDIT:
@@ -86,27 +123,24 @@ def runConfig(config, queue, outdir="", qsub_file=QSUB_TEMPLATE):
         # all '%=config_file' strings in the qsub template with
         # the string stored in cfg_file
         'config_file': cfg_file,
+        'journal_dir': journalDir(outdir),
     }
 
     ################################################################
 
+    return subst_dict
 
 
-    # Create custom string Template from the qsub template
-    with open(qsub_file, 'r') as qsub_template:
-        template = QsubBuilder(qsub_template.read())
-
-    # Create the qsub file from the template using subst_dict
-    run_qsub = os.path.join(runDir, runName + ".qsub")
-    with open(run_qsub, 'w') as qsub:
-        qsub_text = template.substitute(subst_dict)
-        qsub.write(qsub_text)
-
-    #
-    # Submit the job to the scheduler using the temporary qsub file
-    #
-    proc = Popen(['qsub', run_qsub], stdout=PIPE)
-    job_id = proc.stdout.read()
-    job_id = job_id.strip().split('.')
-    queue.put( (job_id[0], runName) )
-
+def checkConfigs(colnames, qsub_file=QSUB_TEMPLATE):
+    """
+    Make sure, before any job is created, that configs with the given
+    columns fill every placeholder in the cfg and qsub templates.
+    """
+    config = dict((col, '') for col in colnames)
+    try:
+        cfg_dict = cfgSubstitutions(config, 'run')
+        qsub_dict = qsubSubstitutions(config, 'run', 'run', 'run.cfg', '')
+    except KeyError as e:
+        raise CTIPError("The config table has no {0} column".format(e))
+    loadTemplate(CFG_TEMPLATE).check(cfg_dict.keys(), CFG_TEMPLATE)
+    loadTemplate(qsub_file).check(qsub_dict.keys(), qsub_file)